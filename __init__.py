@@ -1,17 +1,38 @@
 if "bpy" in locals():
     import imp
 
+    # 依存される側のモジュールから読み込み直す
+    imp.reload(my_files)
     imp.reload(my_srt)
+    imp.reload(my_settings)
+    imp.reload(my_style)
+    imp.reload(my_timeline)
+    imp.reload(render_cache)
+    imp.reload(font_index)
+    imp.reload(my_layout)
+    imp.reload(pil_renderer)
+    imp.reload(render_shard)
     imp.reload(props)
     imp.reload(props_default)
-    imp.reload(ops)
     imp.reload(utils)
+    imp.reload(gimp_server)
+    imp.reload(ops)
 else:
+    from . import my_files
     from . import my_srt
+    from . import my_settings
+    from . import my_style
+    from . import my_timeline
+    from . import render_cache
+    from . import font_index
+    from . import my_layout
+    from . import pil_renderer
+    from . import render_shard
     from . import props
     from . import props_default
-    from . import ops
     from . import utils
+    from . import gimp_server
+    from . import ops
 
 from typing import Any
 import bpy
@@ -81,6 +102,27 @@ class SourcePanel(SrtLoaderPanelBase, bpy.types.Panel):
         row.operator(ops.SrtLoaderResetSrtFile.bl_idname, text="字幕情報の破棄")
         row = layout.row()
         row.operator(ops.SrtLoaderSaveSrtFile.bl_idname, text="Srt Fileへの保存")
+        row.prop(srtloarder_settings, "use_style_table")
+        row = layout.row()
+        watching = ops.SrtLoaderWatchSrtFile.watching
+        row.operator(
+            ops.SrtLoaderWatchSrtFile.bl_idname,
+            text="Srt Fileの監視停止" if watching else "Srt Fileの監視開始",
+            depress=watching,
+        )
+        row = layout.row()
+        autosaving = ops.SrtLoaderAutoSaveSrtFile.autosaving
+        row.operator(
+            ops.SrtLoaderAutoSaveSrtFile.bl_idname,
+            text="自動保存停止" if autosaving else "自動保存開始",
+            depress=autosaving,
+        )
+        row.prop(srtloarder_settings, "autosave_interval", text="間隔(秒)")
+        status = ops.SrtLoaderAutoSaveSrtFile.get_status_text()
+        if status:
+            row = layout.row()
+            icon = "ERROR" if ops.SrtLoaderAutoSaveSrtFile.last_error else "CHECKMARK"
+            row.label(text=status, icon=icon)
 
 
 class JimakuPanel(SrtLoaderPanelBase, bpy.types.Panel):
@@ -102,6 +144,11 @@ class JimakuPanel(SrtLoaderPanelBase, bpy.types.Panel):
         row = layout.row()
         row.operator(ops.SrtLoaderAddJimaku.bl_idname, text="追加")
         row.operator(ops.SrtLoaderRemoveJimaku.bl_idname, text="削除")
+        row = layout.row()
+        row.operator(ops.SrtLoaderLintTimeline.bl_idname, text="タイムラインの検査")
+        row.operator(
+            ops.SrtLoaderMeasureJimakuImages.bl_idname, text="字幕画像の大きさの検査"
+        )
 
         row = layout.row()
         row.separator()
@@ -829,14 +876,50 @@ class JimakuList(bpy.types.UIList):
 class SrtLoaderPreferences(bpy.types.AddonPreferences):
     bl_idname = __name__
 
+    render_backend: bpy.props.EnumProperty(
+        name="作成方法",
+        description="字幕画像の作成方法",
+        items=[
+            ("GIMP", "GIMP", "GIMPを起動して作成する"),
+            ("PILLOW", "Pillow", "Blender内でPillow/NumPyを使って作成する"),
+        ],
+        default="GIMP",
+    )
     gimp_path: bpy.props.StringProperty(
         name="Gimp", description="Gimpのパス", default="/usr/local/bin/gimp"
     )
+    use_render_server: bpy.props.BoolProperty(
+        name="GIMPを使い回す",
+        description="起動したGIMPを終了せずに、次の字幕画像の作成に使い回す",
+        default=True,
+    )
+    render_processes: bpy.props.IntProperty(
+        name="並列数",
+        description="字幕画像を並列に作成するGIMP(Pillowの場合はスレッド)の数",
+        default=2,
+        min=1,
+    )
+    render_server_idle_timeout: bpy.props.IntProperty(
+        name="GIMPの待ち時間",
+        description="字幕画像の作成要求がない場合に、GIMPを終了するまでの時間 (単位: 秒)",
+        default=600,
+        min=10,
+    )
 
     def draw(self, context):
         layout = self.layout
         col = layout.column()
-        col.prop(self, "gimp_path", text="Gimpのパス")
+        col.prop(self, "render_backend")
+        col.prop(self, "render_processes")
+        if self.render_backend == "PILLOW" and not pil_renderer.is_available():
+            col.label(text="PillowまたはNumPyがインストールされていません", icon="ERROR")
+        gimp_col = col.column()
+        gimp_col.enabled = self.render_backend == "GIMP"
+        gimp_col.prop(self, "gimp_path", text="Gimpのパス")
+        gimp_col.prop(self, "use_render_server")
+        row = gimp_col.row()
+        row.enabled = self.use_render_server
+        row.prop(self, "render_server_idle_timeout")
         row = layout.row()
         row.separator()
         row = layout.row()
@@ -926,6 +1009,30 @@ def initialize_styles(dummy):
         print("skip initialize styles")
 
 
+@persistent
+def stop_background_operators(dummy):
+    # 別のblendファイルを開くと、自動保存・監視のモーダルオペレーターは終了するため、
+    # 書き込み中の自動保存を待ってから状態を戻す
+    autosave = ops.SrtLoaderAutoSaveSrtFile
+    autosave.wait_for_saving()
+    autosave.saving_job = None
+    autosave.autosaving = False
+    autosave.modal_running = False
+    autosave.last_saved_at = None
+    autosave.last_error = None
+    ops.SrtLoaderWatchSrtFile.watching = False
+    ops.saved_block_cache.clear()
+
+
+@persistent
+def reset_jimaku_revisions(dummy):
+    # 変更番号はセッション内でのみ一意のため、開いたblendファイルの変更番号は使わない
+    for obj in bpy.data.objects:
+        jimaku_data = getattr(obj, "srtloarder_jimaku", None)
+        if jimaku_data is not None:
+            props.dirty_tracker.reset(jimaku_data)
+
+
 def remove_props():
     del bpy.types.Object.srtloarder_settings
     del bpy.types.Object.srtloarder_jimaku
@@ -946,7 +1053,9 @@ else:
     logging.info(f"preset_dirは未セットアップ: {preset_dir}")
     utils.setup_addon_presets()
 
+bpy.app.handlers.load_pre.append(stop_background_operators)
 bpy.app.handlers.load_post.append(initialize_styles)
+bpy.app.handlers.load_post.append(reset_jimaku_revisions)
 
 
 def register():
@@ -958,6 +1067,7 @@ def register():
 
 
 def unregister():
+    gimp_server.stop_render_servers()
     bpy.types.SEQUENCER_MT_context_menu.remove(menu_fn)
     for c in reversed(classes):
         bpy.utils.unregister_class(c)
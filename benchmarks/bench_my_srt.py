@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+my_srtの読み込み性能を計測するベンチマーク
+
+使い方:
+    python benchmarks/bench_my_srt.py [字幕数]
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import my_srt  # noqa: E402
+
+
+def format_timestamp(ms):
+    return "{:02}:{:02}:{:02},{:03}".format(
+        ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000
+    )
+
+
+def write_sample_srt(path, num_of_cues):
+    extras = json.dumps(
+        {"settings": {"channel_no": 2, "offset_x": 0, "offset_y": -400}}
+    )
+    with open(path, mode="w", encoding="utf-8") as f:
+        t = 0
+        for no in range(1, num_of_cues + 1):
+            start = t
+            end = t + 500 + (no * 37) % 300
+            t = end + (no * 13) % 100
+            json_part = " JSON:{}".format(extras) if no % 10 == 0 else ""
+            f.write(
+                "{}\n{} --> {}{}\n字幕 {} 行目\nsecond line\n\n".format(
+                    no, format_timestamp(start), format_timestamp(end), json_part, no
+                )
+            )
+
+
+def legacy_parse_line_of_time(line):
+    # strptimeを使っていた従来の実装
+    m = re.match(r"\A(\d+:\d+:\d+,\d+) *--> *(\d+:\d+:\d+,\d+) *(.+)?", line)
+    results = {}
+    if m:
+        for k, t in [["start", m.group(1)], ["end", m.group(2)]]:
+            results[k] = my_srt.time_to_delta(datetime.strptime(t, "%H:%M:%S,%f"))
+        if m.group(3):
+            extras = m.group(3)
+            if "JSON:" in extras:
+                results["json"] = json.loads(extras.split("JSON:")[1].strip())
+    return results
+
+
+def legacy_read_srt_file(path):
+    with open(path, encoding="utf-8") as f:
+        results = []
+        for block in my_srt.iter_srt_blocks(f):
+            item = {
+                "no": int(block[0]),
+                "time_info": legacy_parse_line_of_time(block[1]),
+            }
+            item["lines"] = block[2:]
+            results.append(item)
+        return results
+
+
+def measure(label, func, path, num_of_cues):
+    begin = time.perf_counter()
+    result = func(path)
+    elapsed = time.perf_counter() - begin
+    assert len(result) == num_of_cues
+    print("{:<28} {:8.3f} sec {:12,.0f} cues/sec".format(
+        label, elapsed, num_of_cues / elapsed
+    ))
+    return result
+
+
+def main():
+    num_of_cues = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.srt")
+        write_sample_srt(path, num_of_cues)
+        print("cues: {:,}  size: {:,} bytes".format(num_of_cues, os.path.getsize(path)))
+        legacy = measure("strptime (legacy)", legacy_read_srt_file, path, num_of_cues)
+        current = measure("read_srt_file", my_srt.read_srt_file, path, num_of_cues)
+        measure(
+            "read_srt_file(as_table)",
+            lambda p: my_srt.read_srt_file(p, as_table=True),
+            path,
+            num_of_cues,
+        )
+        measure("read_srt_mmap", my_srt.read_srt_mmap, path, num_of_cues)
+        measure(
+            "read_srt_parallel",
+            lambda p: my_srt.read_srt_parallel(p, chunk_size=1024 * 1024),
+            path,
+            num_of_cues,
+        )
+        for a, b in zip(legacy, current):
+            assert a["time_info"]["start"] == b["time_info"]["start"]
+            assert a["time_info"]["end"] == b["time_info"]["end"]
+            assert b["time_info"]["start"] == timedelta(
+                milliseconds=b["time_info"]["start_ms"]
+            )
+
+
+if __name__ == "__main__":
+    main()
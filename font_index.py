@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""
+フォント名からフォントファイルとメトリクスを引くためのインデックス
+
+フォントディレクトリを走査した結果をファイルに保存し、次回からは使い回す。
+記録したディレクトリの更新時刻だけを調べ、変わったディレクトリだけを走査し直す。
+その場合も、更新時刻・サイズが変わったフォントファイルだけを読み直す。
+"""
+import json
+import os
+import shutil
+import struct
+import subprocess
+import threading
+from collections import namedtuple
+
+try:
+    from PIL import ImageFont
+except ImportError:
+    ImageFont = None
+
+try:
+    from . import my_files
+except ImportError:
+    import my_files
+
+# インデックスファイルの形式のバージョン。形式を変えた場合は更新する
+INDEX_VERSION = 1
+DEFAULT_INDEX_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "srt_loader", "font_index.json"
+)
+
+# フォントファイルを探すディレクトリ
+FONT_DIRS = [
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    "~/.fonts",
+    "~/.local/share/fonts",
+    "/System/Library/Fonts",
+    "/Library/Fonts",
+    "~/Library/Fonts",
+    os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts"),
+    os.path.join(os.environ.get("LOCALAPPDATA", ""), "Microsoft", "Windows", "Fonts"),
+]
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc", ".otc")
+COLLECTION_EXTENSIONS = (".ttc", ".otc")
+
+
+def _mul_fix(a, b):
+    sign = -1 if (a < 0) != (b < 0) else 1
+    return sign * ((abs(a) * abs(b) + 0x8000) >> 16)
+
+
+def _div_fix(a, b):
+    return ((a << 16) + b // 2) // b
+
+
+class FontFace(
+    namedtuple(
+        "FontFace",
+        ["path", "index", "family", "style", "units_per_em", "ascender", "descender"],
+    )
+):
+    """
+    フォントファイル内の書体
+
+    index: フォントコレクション内のインデックス
+    units_per_em, ascender, descender: フォントの単位でのメトリクス(hheaテーブル)
+    """
+
+    __slots__ = ()
+
+    def get_metrics(self, size):
+        """
+        フォントを開かずに、ピクセル単位のascent, descentを計算する
+
+        FreeType(PIL.ImageFont.FreeTypeFont.getmetrics)と同じく、
+        26.6固定小数点でスケールしてから切り上げる。
+
+        :param size: フォントサイズ(単位: px)
+        :return (ascent, descent)
+        """
+        y_scale = _div_fix(int(round(size * 64)), self.units_per_em)
+        ascent = (_mul_fix(self.ascender, y_scale) + 63) >> 6
+        descent = (-_mul_fix(self.descender, y_scale) + 63) >> 6
+        return ascent, descent
+
+    def get_line_height(self, size):
+        ascent, descent = self.get_metrics(size)
+        return ascent + descent
+
+
+def normalize_font_name(name):
+    return "".join(name.lower().split())
+
+
+def get_face_names(family, style):
+    """
+    書体を指すフォント名(GIMPでの指定方法)の一覧を返す
+
+    例: ("Noto Sans JP", "Bold") -> ["Noto Sans JP Bold"]
+        ("Noto Sans JP", "Regular") -> ["Noto Sans JP Regular", "Noto Sans JP"]
+    """
+    names = [f"{family} {style}"]
+    if style.lower() in ("regular", "book", "normal", "medium", ""):
+        names.append(family)
+    return names
+
+
+def read_vertical_metrics(path, index=0):
+    """
+    フォントファイルのhead, hheaテーブルから縦方向のメトリクスを読む
+
+    :return (units_per_em, ascender, descender)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    if data[:4] == b"ttcf":
+        offset = struct.unpack_from(">I", data, 12 + 4 * index)[0]
+    num_tables = struct.unpack_from(">H", data, offset + 4)[0]
+    tables = {}
+    for i in range(num_tables):
+        entry_offset = offset + 12 + 16 * i
+        tag, _, table_offset, _ = struct.unpack_from(">4sIII", data, entry_offset)
+        tables[tag] = table_offset
+    units_per_em = struct.unpack_from(">H", data, tables[b"head"] + 18)[0]
+    ascender, descender = struct.unpack_from(">hh", data, tables[b"hhea"] + 4)
+    if ascender == 0 and descender == 0 and b"OS/2" in tables:
+        # hheaにない場合は、FreeTypeと同じくOS/2テーブルの値を使う
+        ascender, descender = struct.unpack_from(">hh", data, tables[b"OS/2"] + 68)
+    return units_per_em, ascender, descender
+
+
+def read_font_faces(path):
+    """
+    フォントファイル内の書体を読み込む (Pillowが必要)
+
+    :return FontFaceの配列。読み込めない場合は空
+    """
+    faces = []
+    index = 0
+    while True:
+        try:
+            font = ImageFont.truetype(path, 10, index=index)
+            metrics = read_vertical_metrics(path, index)
+        except (OSError, KeyError, struct.error):
+            break
+        family, style = font.getname()
+        faces.append(FontFace(path, index, family or "", style or "", *metrics))
+        if not path.lower().endswith(COLLECTION_EXTENSIONS):
+            break
+        index += 1
+    return faces
+
+
+def match_font_with_fontconfig(name):
+    """
+    fontconfig(fc-match)でフォントを探す。fc-matchがない場合はNone
+
+    :return (フォントファイルのパス, コレクション内のインデックス)
+    """
+    fc_match = shutil.which("fc-match")
+    if fc_match is None:
+        return None
+    try:
+        result = subprocess.run(
+            [fc_match, "--format=%{file}\n%{index}\n%{family[0]}", name],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    lines = result.stdout.split("\n")
+    if len(lines) < 3 or not lines[0]:
+        return None
+    # 見つからない場合も代わりのフォントを返すため、ファミリー名を確認する
+    if not normalize_font_name(name).startswith(normalize_font_name(lines[2])):
+        return None
+    return lines[0], int(lines[1] or 0)
+
+
+def get_mtime(path):
+    """
+    更新時刻を返す。存在しない場合はNone
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def list_font_dir(dir_path):
+    """
+    ディレクトリ直下のサブディレクトリとフォントファイルを返す (フォントファイルは開かない)
+
+    :return (更新時刻, {サブディレクトリ}, [フォントファイル])。読めない場合はNone
+    """
+    sub_dirs = set()
+    font_files = []
+    try:
+        mtime = os.stat(dir_path).st_mtime
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    sub_dirs.add(entry.path)
+                elif entry.name.lower().endswith(FONT_EXTENSIONS):
+                    font_files.append(entry.path)
+    except OSError:
+        return None
+    return mtime, sub_dirs, font_files
+
+
+def remove_tree(dirs, files, dir_path):
+    """
+    dir_pathとその下のディレクトリ・フォントファイルを、dirs, filesから削除する
+    """
+    prefix = os.path.join(dir_path, "")
+    for path in [d for d in dirs if d == dir_path or d.startswith(prefix)]:
+        del dirs[path]
+    for path in [f for f in files if f.startswith(prefix)]:
+        del files[path]
+
+
+class FontIndex(object):
+    """
+    フォント名 -> FontFaceのインデックス
+
+    refreshでフォントディレクトリの変更を反映し、saveでindex_pathに保存する。
+    """
+
+    def __init__(self, index_path=None, font_dirs=None):
+        self.index_path = index_path
+        self.font_dirs = font_dirs or FONT_DIRS
+        # 作り直すたびに増える (インデックスを元にしたキャッシュの破棄に使う)
+        self.generation = 0
+        # ディレクトリ -> 更新時刻 (存在しないフォントディレクトリはNone)
+        self._dirs = {}
+        # フォントファイル -> {"mtime", "size", "faces"}
+        self._files = {}
+        # 正規化したフォント名 -> FontFace
+        self._faces = {}
+        # fontconfigで見つけたフォント(インデックスには保存しない)
+        self._matched = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.index_path or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION:
+                return
+            files = {
+                path: dict(entry, faces=[FontFace(*face) for face in entry["faces"]])
+                for path, entry in data["files"].items()
+            }
+            self._dirs = data["dirs"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        self._set_files(files)
+
+    def save(self):
+        if not self.index_path:
+            return
+        data = {"version": INDEX_VERSION, "dirs": self._dirs, "files": self._files}
+        dir_path = os.path.dirname(self.index_path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with my_files.atomic_write(self.index_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def refresh(self):
+        """
+        フォントディレクトリの変更をインデックスに反映する
+
+        フォントファイルの追加・削除・置き換えではディレクトリの更新時刻が変わるため、
+        記録したディレクトリの更新時刻を調べ、変わったディレクトリだけを走査し直す。
+
+        :return インデックスを作り直した場合はTrue
+        """
+        if ImageFont is None:
+            return False
+        with self._lock:
+            roots = [os.path.expanduser(font_dir) for font_dir in self.font_dirs]
+            if all(root in self._dirs for root in roots):
+                dirs = dict(self._dirs)
+                pending = [d for d, mtime in dirs.items() if get_mtime(d) != mtime]
+                if not pending:
+                    return False
+                files = dict(self._files)
+            else:
+                # 初回、またはフォントディレクトリが変わった場合は全て走査する
+                dirs = {}
+                pending = list(roots)
+                files = {}
+            files_by_dir = {}
+            for path in files:
+                files_by_dir.setdefault(os.path.dirname(path), []).append(path)
+            while pending:
+                dir_path = pending.pop()
+                listing = list_font_dir(dir_path)
+                if listing is None:
+                    # 削除されたディレクトリ(存在しないフォントディレクトリは記録しておく)
+                    remove_tree(dirs, files, dir_path)
+                    if dir_path in roots:
+                        dirs[dir_path] = None
+                    continue
+                mtime, sub_dirs, font_files = listing
+                dirs[dir_path] = mtime
+                for sub_dir in sub_dirs:
+                    if sub_dir not in dirs:
+                        pending.append(sub_dir)
+                # 削除されたサブディレクトリ
+                for known_dir in list(dirs):
+                    if (
+                        os.path.dirname(known_dir) == dir_path
+                        and known_dir not in sub_dirs
+                        and known_dir not in roots
+                    ):
+                        remove_tree(dirs, files, known_dir)
+                for path in files_by_dir.pop(dir_path, []):
+                    files.pop(path, None)
+                for path in font_files:
+                    files[path] = self._read_file_entry(path)
+            self._dirs = dirs
+            self._set_files(dict((k, v) for k, v in files.items() if v is not None))
+            return True
+
+    def _read_file_entry(self, path):
+        """
+        フォントファイルの書体を読む。更新時刻・サイズが変わっていなければ読み直さない
+
+        :return {"mtime", "size", "faces"}。ファイルがない場合はNone
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entry = self._files.get(path)
+        if entry is None or (entry["mtime"], entry["size"]) != (
+            st.st_mtime,
+            st.st_size,
+        ):
+            entry = {
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+                "faces": read_font_faces(path),
+            }
+        return entry
+
+    def _set_files(self, files):
+        faces = {}
+        for path in sorted(files):
+            for face in files[path]["faces"]:
+                for name in get_face_names(face.family, face.style):
+                    faces.setdefault(normalize_font_name(name), face)
+        self._files = files
+        self._faces = faces
+        self._matched = {}
+        self.generation += 1
+
+    def find(self, name):
+        """
+        フォント名("Noto Sans JP Bold"など)から書体を探す
+
+        インデックスにない場合は、fontconfigで探す。
+
+        :param str name: フォント名(GIMPのフォント名と同じく、ファミリー名とスタイル名)
+        :return FontFace。見つからない場合はNone
+        """
+        key = normalize_font_name(name)
+        face = self._faces.get(key)
+        if face is not None:
+            return face
+        if key not in self._matched:
+            face = None
+            found = match_font_with_fontconfig(name)
+            if found is not None and ImageFont is not None:
+                faces = [f for f in read_font_faces(found[0]) if f.index == found[1]]
+                face = faces[0] if faces else None
+            self._matched[key] = face
+        return self._matched[key]
+
+
+# インデックスファイルのパス -> FontIndex
+_font_indexes = {}
+_font_indexes_lock = threading.Lock()
+
+
+def get_font_index(index_path=DEFAULT_INDEX_PATH):
+    """
+    フォントディレクトリの変更を反映したFontIndexを返す
+
+    同じindex_pathでは同じFontIndexをセッション中使い回す。呼び出しごとに調べるのは
+    記録したディレクトリの更新時刻だけで、変わったディレクトリを走査し直した場合だけ保存する。
+    """
+    with _font_indexes_lock:
+        index = _font_indexes.get(index_path)
+        if index is None:
+            index = _font_indexes[index_path] = FontIndex(index_path)
+    if index.refresh():
+        index.save()
+    return index
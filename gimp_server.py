@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import secrets
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import utils
+from .render_shard import RenderShard
+
+# GIMPの起動を待つ最大時間(単位: 秒)
+STARTUP_TIMEOUT = 120
+# GIMPの終了を待つ最大時間(単位: 秒)
+SHUTDOWN_TIMEOUT = 10
+# 字幕画像作成サーバーに1回で依頼する字幕数(進捗の更新単位)
+RENDER_BATCH_SIZE = 10
+# subtitle_creator.PROGRESS_PREFIXと同じ値
+PROGRESS_PREFIX = "progress:"
+
+
+class GimpRenderError(Exception):
+    pass
+
+
+class GimpServerError(GimpRenderError):
+    pass
+
+
+class GimpRenderServer:
+    """
+    字幕画像作成サーバー(subtitle_creator.serve)として動作するGIMPを管理する
+
+    GIMPは最初の要求時に起動し、以降の要求で使い回す。
+    GIMPが終了していた場合(待ち時間の超過やクラッシュ)は、起動し直して要求を送り直す。
+    """
+
+    def __init__(self):
+        self._proc = None
+        self._work_dir = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    @property
+    def port_path(self):
+        return os.path.join(self._work_dir, "server.port")
+
+    @property
+    def log_path(self):
+        return os.path.join(self._work_dir, "server.log")
+
+    def is_running(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self, gimp_path, idle_timeout):
+        self.stop()
+        self._work_dir = tempfile.mkdtemp(prefix="srt_loader_gimp_")
+        self._token = secrets.token_hex(16)
+        script = utils.create_gimp_server_script(
+            self.port_path, self._token, idle_timeout
+        )
+        logging.info(f"start gimp render server: {self._work_dir}")
+        with open(self.log_path, "w") as log:
+            self._proc = subprocess.Popen(
+                utils.create_gimp_command_line(gimp_path),
+                shell=True,
+                stdin=subprocess.PIPE,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                text=True,
+            )
+        self._proc.stdin.write(script)
+        self._proc.stdin.close()
+
+    def stop(self):
+        if self._proc is None:
+            return
+        if self.is_running():
+            try:
+                if os.path.exists(self.port_path):
+                    self.request({"command": "shutdown"})
+                self._proc.wait(timeout=SHUTDOWN_TIMEOUT)
+            except (OSError, ValueError, GimpServerError, subprocess.TimeoutExpired):
+                self._proc.kill()
+                self._proc.wait()
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+        self._proc = None
+        self._work_dir = None
+
+    def read_log(self, max_chars=4000):
+        try:
+            with open(self.log_path, encoding="utf-8", errors="replace") as f:
+                return f.read()[-max_chars:]
+        except OSError:
+            return ""
+
+    def wait_for_port(self, timeout=STARTUP_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(self.port_path):
+            if not self.is_running():
+                raise GimpServerError(f"GIMPが終了しました\n{self.read_log()}")
+            if time.monotonic() > deadline:
+                raise GimpServerError("GIMPの起動がタイムアウトしました")
+            time.sleep(0.1)
+        with open(self.port_path) as f:
+            return json.load(f)["port"]
+
+    def request(self, request):
+        port = self.wait_for_port()
+        request = dict(request, token=self._token)
+        with socket.create_connection(("127.0.0.1", port)) as conn:
+            f = conn.makefile("rwb")
+            # 字幕データの時刻(timedelta)は文字列として送る(GIMP側では使わない)
+            f.write(json.dumps(request, default=str).encode("utf-8") + b"\n")
+            f.flush()
+            line = f.readline()
+        if not line:
+            raise GimpServerError(f"GIMPから応答がありません\n{self.read_log()}")
+        return json.loads(line)
+
+    def render(self, gimp_path, job, idle_timeout):
+        """
+        字幕画像を作成する (作成が終わるまでブロックする)
+
+        :param str gimp_path: GIMPのパス
+        :param dict job: subtitle_creator.renderの引数(subtitles, config, output_path,
+                         default_config, cache_dir)
+        :param int idle_timeout: GIMPを起動する場合の、要求を待つ時間(単位: 秒)
+        """
+        with self._lock:
+            for retry in (False, True):
+                if not self.is_running():
+                    self.start(gimp_path, idle_timeout)
+                try:
+                    result = self.request(dict(job, command="render"))
+                except (OSError, GimpServerError) as e:
+                    if retry:
+                        raise
+                    logging.warning(f"gimp render server is down, restarting: {e}")
+                    self.stop()
+                    continue
+                if result["status"] != "ok":
+                    raise GimpServerError(result.get("message", "字幕画像の作成に失敗"))
+                return
+
+
+# 字幕画像作成サーバー(並列で作成するため複数起動する)
+render_servers = []
+
+
+def get_render_server(index=0):
+    while len(render_servers) <= index:
+        render_servers.append(GimpRenderServer())
+    return render_servers[index]
+
+
+def stop_render_servers():
+    for server in render_servers:
+        server.stop()
+
+
+class ServerRenderShard(RenderShard):
+    """
+    字幕画像作成サーバーに、RENDER_BATCH_SIZEずつ作成を依頼する
+    """
+
+    def __init__(self, gimp_path, job, server, idle_timeout):
+        super().__init__(job)
+        self.gimp_path = gimp_path
+        self.server = server
+        self.idle_timeout = idle_timeout
+
+    def run(self):
+        subtitles = self.job["subtitles"]
+        for i in range(0, len(subtitles), RENDER_BATCH_SIZE):
+            batch = subtitles[i : i + RENDER_BATCH_SIZE]
+            self.server.render(
+                self.gimp_path, dict(self.job, subtitles=batch), self.idle_timeout
+            )
+            self.done += len(batch)
+
+
+class ProcessRenderShard(RenderShard):
+    """
+    GIMPを起動して作成し、標準出力の進捗を読み取る (作成後にGIMPは終了する)
+    """
+
+    def __init__(self, gimp_path, job):
+        super().__init__(job)
+        self.gimp_path = gimp_path
+
+    def run(self):
+        script = utils.create_gimp_script(
+            self.job["subtitles"],
+            self.job["config"],
+            self.job["output_path"],
+            self.job["default_config"],
+            cache_dir=self.job.get("cache_dir"),
+        )
+        logging.info(f"script: \n{script}")
+        proc = subprocess.Popen(
+            utils.create_gimp_command_line(self.gimp_path),
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        proc.stdin.write(script)
+        proc.stdin.close()
+        output = []
+        with proc.stdout:
+            for line in proc.stdout:
+                if line.startswith(PROGRESS_PREFIX):
+                    self.done += 1
+                else:
+                    output.append(line)
+        self.output = "".join(output)
+        ret = proc.wait()
+        if ret != 0:
+            raise GimpRenderError(f"GIMPが異常終了しました({ret})\n{self.output}")
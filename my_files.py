@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+ファイルの置き換えと、キャッシュファイルの削除
+
+GIMP(Python 2)とBlender(Python 3)の両方から使う。
+"""
+import contextlib
+import errno
+import io
+import os
+import tempfile
+
+
+def replace_file(src_path, dest_path):
+    """
+    src_pathをdest_pathにリネームする。dest_pathがある場合は置き換える (os.replaceに相当)
+
+    Python 2にはos.replaceがなく、Windowsのos.renameはdest_pathがあると失敗するため、
+    その場合はdest_pathを削除してからリネームする。
+    """
+    if hasattr(os, "replace"):
+        os.replace(src_path, dest_path)
+        return
+    try:
+        os.rename(src_path, dest_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        os.remove(dest_path)
+        os.rename(src_path, dest_path)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="wb", **kwargs):
+    """
+    同じディレクトリの一時ファイルに書き込んでから、pathを置き換える
+
+    書き込み途中で失敗しても、pathが中途半端な状態になることはない。
+    pathがある場合はそのパーミッションを引き継ぎ、ない場合は0o644にする。
+
+    例:
+        with atomic_write(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    :param str path: 書き込み先のパス
+    :param str mode: 一時ファイルを開くモード ("w"または"wb")
+    :param kwargs: io.openに渡す引数(encoding, newline, bufferingなど)
+    """
+    try:
+        permission = os.stat(path).st_mode & 0o7777
+    except OSError:
+        permission = 0o644
+    dir_path = os.path.dirname(path) or None
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=dir_path)
+    try:
+        with io.open(fd, mode, **kwargs) as f:
+            yield f
+        os.chmod(tmp_path, permission)
+        replace_file(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def evict_old_files(dir_path, suffix, max_bytes):
+    """
+    dir_path以下のsuffixで終わるファイルの合計サイズがmax_bytesを超えた場合、
+    更新時刻が古いものから削除する (キャッシュのLRU)
+
+    他のプロセスが同時に削除しても失敗しない。
+    """
+    entries = []
+    total = 0
+    for root, _, file_names in os.walk(dir_path):
+        for name in file_names:
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+字幕画像を作成せずに、字幕画像の大きさを計算する
+
+pil_rendererと同じレイアウトを、グリフの外接矩形と送り幅だけで計算する。
+フォントのメトリクスはfont_indexから求め、ピクセルの配列は作らない。
+"""
+import math
+from collections import namedtuple
+
+try:
+    from PIL import ImageFont
+except ImportError:
+    ImageFont = None
+
+try:
+    from . import font_index
+    from . import my_settings
+    from . import my_style
+except ImportError:
+    import font_index
+    import my_settings
+    import my_style
+
+# GIMPの選択範囲のぼかし(gimp_selection_feather)の半径から、ガウスぼかしの標準偏差への変換率
+FEATHER_SIGMA_RATE = 1 / 3.5
+# MetricsCacheが保持するグリフの最大数
+DEFAULT_METRICS_CACHE_SIZE = 65536
+
+# グリフの外接矩形と送り幅
+#   offset_x, offset_y: ベースライン上のペンの位置から、外接矩形の左上までの位置
+#   width, height: 外接矩形の大きさ
+#   advance: 次の文字までのペンの移動量
+GlyphBox = namedtuple(
+    "GlyphBox", ["offset_x", "offset_y", "width", "height", "advance"]
+)
+
+# 字幕画像の大きさの計算結果
+#   no: 字幕番号
+#   width, height: 字幕画像の大きさ
+#   text_x, text_y, text_width, text_height: 字幕画像内のテキストの範囲
+#   line_widths: 各行の幅
+#   clipped: 縁取り・影・ボックスが切り抜きで欠ける辺("left", "top", "right", "bottom")
+Measurement = namedtuple(
+    "Measurement",
+    [
+        "no",
+        "width",
+        "height",
+        "text_x",
+        "text_y",
+        "text_width",
+        "text_height",
+        "line_widths",
+        "clipped",
+    ],
+)
+
+SIDES = ("left", "top", "right", "bottom")
+
+
+def is_available():
+    return ImageFont is not None
+
+
+def to_px(value):
+    return int(round(value))
+
+
+def resolve_justify(name):
+    return name if name in ("left", "right", "center") else "left"
+
+
+class MetricsCache(object):
+    """
+    フォント・サイズごとに、グリフの外接矩形と送り幅をキャッシュする
+
+    FreeTypeFontはスレッド間で共有できないため、1つのスレッドで使うこと。
+    """
+
+    def __init__(self, fonts, maxsize=DEFAULT_METRICS_CACHE_SIZE):
+        """
+        :param font_index.FontIndex fonts: フォント名からフォントファイルを探すインデックス
+        """
+        self.fonts = fonts
+        self.generation = fonts.generation
+        self.maxsize = maxsize
+        self._fonts = {}
+        self._boxes = {}
+
+    def get_face(self, font_family):
+        face = self.fonts.find(font_family)
+        if face is None:
+            raise ValueError(f"フォントが見つかりません: {font_family}")
+        return face
+
+    def get_font(self, font_family, font_size):
+        key = (font_family, font_size)
+        font = self._fonts.get(key)
+        if font is None:
+            face = self.get_face(font_family)
+            font = ImageFont.truetype(face.path, font_size, index=face.index)
+            self._fonts[key] = font
+        return font
+
+    def get_metrics(self, font_family, font_size):
+        """
+        :return (ascent, descent)。フォントのインデックスから計算する
+        """
+        return self.get_face(font_family).get_metrics(font_size)
+
+    def get_glyph(self, font_family, font_size, char):
+        key = (font_family, font_size, char)
+        box = self._boxes.get(key)
+        if box is None:
+            font = self.get_font(font_family, font_size)
+            left, top, right, bottom = font.getbbox(char, anchor="ls")
+            advance = font.getlength(char)
+            if right <= left or bottom <= top:
+                box = GlyphBox(0, 0, 0, 0, advance)
+            else:
+                box = GlyphBox(left, top, right - left, bottom - top, advance)
+            if len(self._boxes) >= self.maxsize:
+                self._boxes.clear()
+            self._boxes[key] = box
+        return box
+
+
+def layout_text(text, glyphs, style):
+    """
+    テキストの各文字の位置を計算する (GIMPのテキストレイヤーと同じく、
+    行の高さはフォントのascent+descentに行間の調整幅を加えたもの)
+
+    :param str text: 字幕のテキスト
+    :param glyphs: グリフのキャッシュ(MetricsCache, pil_renderer.GlyphCache)
+    :param my_style.CompiledStyle style: スタイル
+    :return (テキストの幅, テキストの高さ, [(グリフ, x, ベースラインのy)], [各行の幅])
+    """
+    family, size = style.font_family, style.font_size
+    ascent, descent = glyphs.get_metrics(family, size)
+    line_height = ascent + descent + style.line_spacing
+    lines = [
+        [glyphs.get_glyph(family, size, char) for char in line]
+        for line in text.split("\n")
+    ]
+    widths = [sum(glyph.advance for glyph in line) for line in lines]
+    text_w = max(widths)
+    text_h = ascent + descent + line_height * (len(lines) - 1)
+    placed = []
+    for i, (line, line_w) in enumerate(zip(lines, widths)):
+        if style.justify == "right":
+            x = text_w - line_w
+        elif style.justify == "center":
+            x = (text_w - line_w) / 2
+        else:
+            x = 0
+        y = line_height * i + ascent
+        for glyph in line:
+            placed.append((glyph, x, y))
+            x += glyph.advance
+    return to_px(text_w), to_px(text_h), placed, widths
+
+
+def get_text_bounds(placed, offset_x, offset_y):
+    """
+    グリフの外接矩形を合わせた範囲を返す (pil_renderer.compose_textと同じ位置で計算する)
+
+    :return (幅, 高さ, x, y)。範囲がない場合はNone
+    """
+    x1 = y1 = x2 = y2 = None
+    for glyph, x, y in placed:
+        if not glyph.width:
+            continue
+        gx = to_px(offset_x + x) + glyph.offset_x
+        gy = to_px(offset_y + y) + glyph.offset_y
+        if x1 is None:
+            x1, y1, x2, y2 = gx, gy, gx + glyph.width, gy + glyph.height
+        else:
+            x1 = min(x1, gx)
+            y1 = min(y1, gy)
+            x2 = max(x2, gx + glyph.width)
+            y2 = max(y2, gy + glyph.height)
+    if x1 is None:
+        return None
+    return (x2 - x1, y2 - y1, x1, y1)
+
+
+def get_decoration_margins(style):
+    """
+    縁取り・影・ボックスが、テキストの範囲からはみ出す幅を返す
+
+    :return (左, 上, 右, 下)の幅(単位: px)
+    """
+    border = 0
+    radius = 0
+    for b in style.borders:
+        if not b:
+            continue
+        radius += int(b.grow)
+        feather = int(math.ceil(3 * b.feather * FEATHER_SIGMA_RATE))
+        border = max(border, radius + feather)
+    margins = [border] * 4
+    shadow = style.shadow
+    if shadow and shadow.opacity > 0:
+        blur = border + int(math.ceil(3 * shadow.blur_radius * FEATHER_SIGMA_RATE))
+        dx, dy = to_px(shadow.offset_x), to_px(shadow.offset_y)
+        shadow_margins = (blur - dx, blur - dy, blur + dx, blur + dy)
+        margins = [max(m, s) for m, s in zip(margins, shadow_margins)]
+    box = style.box
+    if box:
+        pdx, pdy = to_px(box.padding_x), to_px(box.padding_y)
+        margins = [max(m, p) for m, p in zip(margins, (pdx, pdy, pdx, pdy))]
+    return tuple(margins)
+
+
+def measure_subtitle(no, text, style, glyphs):
+    """
+    字幕画像1つの大きさを計算する
+
+    :return Measurement
+    """
+    _, _, placed, line_widths = layout_text(text, glyphs, style)
+    offset_x = to_px(style.canvas_padding_x)
+    offset_y = to_px(style.canvas_padding_y)
+    bounds = get_text_bounds(placed, offset_x, offset_y)
+    if bounds is None:
+        bounds = (0, 0, offset_x, offset_y)
+    pdx = to_px(style.crop_padding_x)
+    pdy = to_px(style.crop_padding_y)
+    margins = get_decoration_margins(style)
+    clipped = tuple(
+        side for side, m, p in zip(SIDES, margins, (pdx, pdy, pdx, pdy)) if m > p
+    )
+    return Measurement(
+        no,
+        bounds[0] + pdx * 2,
+        bounds[1] + pdy * 2,
+        pdx,
+        pdy,
+        bounds[0],
+        bounds[1],
+        tuple(to_px(w) for w in line_widths),
+        clipped,
+    )
+
+
+def measure_subtitles(subtitles, settings, fonts=None):
+    """
+    字幕画像の大きさを計算する (pil_renderer.generate_subtitlesと同じ設定のマージを行う)
+
+    :param subtitles: 字幕データ(subtitle_creator.generate_subtitlesと同じ)
+    :param dict settings: マージ済みの設定
+    :param font_index.FontIndex fonts: フォントのインデックス。Noneの場合はデフォルト
+    :return Measurementの配列
+    """
+    if fonts is None:
+        fonts = font_index.get_font_index()
+    merger = my_settings.SettingsMerger(settings)
+    compiler = my_style.StyleCompiler(None, resolve_justify)
+    glyphs = MetricsCache(fonts)
+    # 同じテキスト・スタイルの字幕は計算結果を使い回す
+    measured = {}
+    results = []
+    for st in subtitles:
+        text = "\n".join(st["lines"])
+        style = compiler.compile(merger.merge(st["time_info"].get("json")))
+        key = (text, style)
+        m = measured.get(key)
+        if m is None:
+            m = measured[key] = measure_subtitle(st["no"], text, style, glyphs)
+        results.append(m._replace(no=st["no"]))
+    return results
+
+
+def measure(subtitles, config, default_config, font_index_path=None):
+    """
+    字幕画像の大きさを計算する (引数はpil_renderer.renderと同じ)
+    """
+    if not is_available():
+        raise RuntimeError("Pillowがインストールされていません")
+    merged_config = my_settings.merge_settings(default_config, config)
+    fonts = font_index.get_font_index(font_index_path or font_index.DEFAULT_INDEX_PATH)
+    return measure_subtitles(subtitles, merged_config, fonts)
+
+
+def find_overflow(m, offset_x, offset_y, frame_width, frame_height):
+    """
+    字幕画像のテキストが、画面からはみ出す辺を返す
+
+    字幕画像は、上辺の中心を画面の中心から(offset_x, offset_y)の位置に配置する
+    (ops.create_image_stripsと同じ)。y軸は上向き。
+
+    :param Measurement m: 字幕画像の大きさ
+    :return はみ出す辺("left", "top", "right", "bottom")のタプル
+    """
+    left = offset_x - m.width / 2 + m.text_x
+    right = left + m.text_width
+    top = offset_y - m.text_y
+    bottom = top - m.text_height
+    half_w = frame_width / 2
+    half_h = frame_height / 2
+    overflow = (left < -half_w, top > half_h, right > half_w, bottom < -half_h)
+    return tuple(side for side, over in zip(SIDES, overflow) if over)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import json
+from collections import OrderedDict
 from io import open
 import copy
 
@@ -55,3 +56,95 @@ def merge_settings(config1, config2):
             # config2側を採用
             merged[key] = copy.copy(config2[key])
     return merged
+
+
+# SettingsMergerが保持するマージ結果の最大数
+DEFAULT_MERGE_CACHE_SIZE = 256
+
+
+class FrozenDict(dict):
+    """
+    変更できないdict (マージ結果を複数の字幕で共有するために使う)
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenDict is read-only")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    """
+    設定を変更できないオブジェクトに変換する (dictはFrozenDict、listはtupleに変換)
+    """
+    if isinstance(value, FrozenDict):
+        return value
+    elif isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    else:
+        return value
+
+
+def get_fingerprint(override):
+    """
+    字幕個別の設定の内容を表す文字列を返す (キーの順序や空白の違いは無視する)
+    """
+    data = getattr(override, "data", override)
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+class SettingsMerger(object):
+    """
+    基本の設定と字幕個別の設定のマージ結果をキャッシュする
+
+    字幕個別の設定の内容(get_fingerprint)が同じ場合は、同じマージ結果を返す。
+    マージ結果は共有されるため、変更できないオブジェクト(freeze)として返す。
+    キャッシュはmaxsizeを超えると、最も古く使われたものから削除する。
+    """
+
+    def __init__(self, base, maxsize=DEFAULT_MERGE_CACHE_SIZE):
+        self.base = base
+        self.maxsize = maxsize
+        self.frozen_base = freeze(base)
+        self._cache = OrderedDict()
+        # LazyJsonの文字列から、内容を表す文字列への対応
+        self._fingerprints = {}
+
+    def merge(self, override):
+        """
+        :param override: 字幕個別の設定(dict/LazyJson)。Noneや空の場合は基本の設定を返す
+        :return マージした設定(FrozenDict)
+        """
+        if not override:
+            return self.frozen_base
+        key = self.get_key(override)
+        result = self._cache.pop(key, None)
+        if result is None:
+            result = freeze(merge_settings(self.base, override))
+            if len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+        self._cache[key] = result
+        return result
+
+    def get_key(self, override):
+        raw = getattr(override, "raw", None)
+        if raw is None:
+            return get_fingerprint(override)
+        key = self._fingerprints.get(raw)
+        if key is None:
+            if len(self._fingerprints) >= self.maxsize:
+                self._fingerprints.clear()
+            key = self._fingerprints[raw] = get_fingerprint(override)
+        return key
@@ -1,10 +1,32 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime, timedelta
+from datetime import timedelta
+import binascii
+import fnmatch
+import glob
+import hashlib
 import json
+import mmap
+import multiprocessing
 import os
+import pickle
 import re
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
 from io import open
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # GIMP(Python 2)用
+    from collections import Mapping
+
+try:
+    from . import my_files
+except (ImportError, ValueError):
+    # GIMP(Python 2)用
+    import my_files
+
 
 def time_to_delta(t):
     return timedelta(
@@ -12,58 +34,965 @@ def time_to_delta(t):
     )
 
 
-def read_srt_file(path):
+def read_srt_file(path, as_table=False, use_mmap=False):
     """
     字幕ファイルを読み込む
 
     :param str path: 字幕ファイル(SubRip形式)のパス
-    :return itemのリスト
+    :param bool as_table: Trueの場合、itemのリストの代わりにCueTableを返す
+    :param bool use_mmap: Trueの場合、ファイルをメモリマップしてバイト列のまま走査する
+                          (read_srt_mmapを参照)
+    :return itemのリスト (スタイル表のスタイル参照は展開済み。attach_style_tableを参照)
             itemは以下の形式
             {"no": 1からの連番,
-             "time_info": {"start": timedelta, "end": timedelter},
+             "time_info": {"start": timedelta, "end": timedelter,
+                           "start_ms": int, "end_ms": int},
              "lines": 字幕文字列の配列 }
     """
-    item_list = []
+    if use_mmap:
+        table = read_srt_mmap(path)
+        return table if as_table else table.to_items()
+    if as_table:
+        with open(path, encoding="utf-8") as f:
+            return attach_style_table(CueTable.from_blocks(iter_srt_blocks(f)), path)
+    return list(iter_srt(path))
+
+
+def iter_srt(path):
+    """
+    字幕ファイルを1字幕ずつ読み込むジェネレーター
+
+    ファイル全体をメモリに保持せず、itemを1件ずつ返す
+
+    :param str path: 字幕ファイル(SubRip形式)のパス
+    :return itemのジェネレーター (itemの形式はread_srt_fileと同じ)
+    """
+    style_table = read_style_table(path)
     with open(path, encoding="utf-8") as f:
-        item = {}
-        for line_with_sep in f:
-            line = line_with_sep.rstrip(os.linesep)
-            if len(line) == 0:
-                if len(item) > 0:
-                    item_list.append(item)
-                    item = {}
-            elif len(item) == 0:
-                item["no"] = int(line)
-            elif len(item) == 1:
-                if "-->" not in line:
-                    raise ValueError("Bad time format:{}".format(item))
-                item["time_info"] = parse_line_of_time(line)
-            elif len(item) == 2:
-                item["lines"] = []
-                item["lines"].append(line)
-            elif len(item) == 3:
-                item["lines"].append(line)
-
-        if len(item) > 0:
-            item_list.append(item)
-
-    return item_list
-
-
-def parse_line_of_time(line):
-    m = re.match(r"\A(\d+:\d+:\d+,\d+) *--> *(\d+:\d+:\d+,\d+) *(.+)?", line)
+        for item in resolve_style_refs(iter_srt_file(f), style_table):
+            yield item
+
+
+def iter_srt_file(f):
+    """
+    ファイルオブジェクトから字幕を1字幕ずつ読み込むジェネレーター
+
+    :param f: 字幕データ(SubRip形式)を読み込めるテキストファイルオブジェクト
+    :return itemのジェネレーター (itemの形式はread_srt_fileと同じ)
+    """
+    for block in iter_srt_blocks(f):
+        yield parse_block(block)
+
+
+def iter_srt_blocks(f):
+    """
+    空行で区切られた字幕ブロックを、行の配列として1ブロックずつ返す
+
+    :param f: 字幕データ(SubRip形式)を読み込めるテキストファイルオブジェクト
+    :return 行の配列(改行文字は含まない)のジェネレーター
+    """
+    block = []
+    for line_with_sep in f:
+        line = line_with_sep.rstrip("\r\n")
+        if len(line) == 0:
+            if len(block) > 0:
+                yield block
+                block = []
+        else:
+            block.append(line)
+
+    if len(block) > 0:
+        yield block
+
+
+DIGEST_SIZE = 16
+
+
+def block_hash(block):
+    return hashlib.md5(u"\n".join(block).encode("utf-8"))
+
+
+def block_digest(block):
+    """
+    字幕ブロック(行の配列)のハッシュ値を返す
+
+    :param list block: iter_srt_blocksが返す行の配列
+    :return str 16進数のハッシュ値
+    """
+    return block_hash(block).hexdigest()
+
+
+def block_text_digest(text):
+    """
+    書き出す字幕ブロックの文字列から、読み込み時と同じハッシュ値を計算する
+
+    読み込み時と同じくiter_srt_blocksで行に分割するため、空行(字幕文字列が空の場合の
+    末尾の空行など)は含まれない
+
+    :param str text: 字幕ブロックの文字列(末尾の空行を含まない)
+    :return str 16進数のハッシュ値
+    """
+    for block in iter_srt_blocks(text.split(u"\n")):
+        return block_digest(block)
+    return block_digest([])
+
+
+def parse_block(block):
+    """
+    字幕ブロック(行の配列)をitemに変換する
+
+    :param list block: iter_srt_blocksが返す行の配列
+    :return item (形式はread_srt_fileと同じ)
+    """
+    item = {"no": int(block[0])}
+    if len(block) >= 2:
+        if "-->" not in block[1]:
+            raise ValueError("Bad time format:{}".format(item))
+        item["time_info"] = parse_line_of_time(block[1])
+    if len(block) >= 3:
+        item["lines"] = block[2:]
+    return item
+
+
+PARSER_VERSION = 2
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+
+class SrtParseCache(object):
+    """
+    字幕ファイルの解析結果(CueTable)をディスクに保存するキャッシュ
+
+    ファイルの絶対パス、サイズ、更新時刻、PARSER_VERSIONが一致する場合のみ利用する。
+    キャッシュの合計サイズがmax_bytesを超えた場合、最も古く使われたものから削除する。
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def get_key(self, path):
+        abs_path = os.path.abspath(path)
+        st = os.stat(abs_path)
+        mtime_ns = getattr(st, "st_mtime_ns", int(st.st_mtime * 1e9))
+        return (abs_path, st.st_size, mtime_ns, PARSER_VERSION)
+
+    def get_cache_path(self, key):
+        name = hashlib.sha1(key[0].encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name + ".cache")
+
+    def load(self, path):
+        """
+        字幕ファイルをCueTable(ハッシュ値付き)として読み込む。キャッシュがあれば解析しない
+        """
+        key = self.get_key(path)
+        table = self.get(key)
+        if table is None:
+            with open(key[0], encoding="utf-8") as f:
+                table = CueTable.from_blocks(iter_srt_blocks(f), with_digests=True)
+            self.put(key, table)
+        return attach_style_table(table, key[0])
+
+    def get(self, key):
+        cache_path = self.get_cache_path(key)
+        try:
+            with open(cache_path, "rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot.get("key") != key:
+                return None
+            no, start_ms, end_ms, text, text_start, text_end, extras, digests = (
+                snapshot["table"]
+            )
+            extras = dict((i, intern_json(raw)) for i, raw in extras.items())
+            table = CueTable(
+                no, start_ms, end_ms, text, text_start, text_end, extras, digests
+            )
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # 壊れたキャッシュや形式の異なるキャッシュは削除して、解析し直す
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+            return None
+        try:
+            # LRU用に最終利用時刻を更新
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+        return table
+
+    def put(self, key, table):
+        if not isinstance(table.text, text_type):
+            # mmapを参照する表はキャッシュしない
+            return
+        snapshot = {
+            "key": key,
+            "table": (
+                table.no,
+                table.start_ms,
+                table.end_ms,
+                table.text,
+                table.text_start,
+                table.text_end,
+                dict((i, extras.raw) for i, extras in table.extras.items()),
+                table.digests,
+            ),
+        }
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            cache_path = self.get_cache_path(key)
+            with my_files.atomic_write(cache_path) as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            self.evict()
+        except (IOError, OSError):
+            # キャッシュに書き込めなくても(読み取り専用、ディスクフルなど)、読み込みは続ける
+            pass
+
+    def evict(self):
+        my_files.evict_old_files(self.cache_dir, ".cache", self.max_bytes)
+
+
+CUE_BLOCK_PATTERN = re.compile(
+    # 行頭(ファイル先頭のBOMの直後を含む)の字幕番号から始まるブロック
+    br"(?:^|(?<=\A\xef\xbb\xbf))(\d+)[ \t]*(?:\r?\n)"
+    br"(\d+):(\d+):(\d+),(\d+) *--> *(\d+):(\d+):(\d+),(\d+)([^\r\n]*)"
+    br"(?:\r?\n|\Z)"
+    br"((?:[^\r\n]+(?:\r?\n[^\r\n]+)*)?)",
+    re.M,
+)
+UTF8_BOM = b"\xef\xbb\xbf"
+
+
+def read_srt_mmap(path):
+    """
+    字幕ファイルをメモリマップし、バイト列のまま字幕の境界を探してCueTableを作成する
+
+    字幕文字列はファイル上の位置だけを記録し、参照されたときにデコードする。
+    改行コードはLF/CRLFのどちらでも良い。
+
+    :param str path: 字幕ファイル(SubRip形式)のパス
+    :return CueTable (textはmmap)
+    """
+    buf = map_srt_file(path)
+    if buf is None:
+        return CueTable()
+    return attach_style_table(scan_cues(buf), path)
+
+
+def map_srt_file(path):
+    """
+    字幕ファイルを読み込み専用でメモリマップする。空のファイルの場合はNone
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def scan_cues(buf, start=0, end=None):
+    """
+    バイト列(bytes/mmap)のstartからendまでを走査してCueTableを作成する
+
+    :return CueTable (textはbuf、text_start/text_endはbuf上の位置)
+    """
+    if end is None:
+        end = len(buf)
+    if start == 0 and buf[:len(UTF8_BOM)] == UTF8_BOM:
+        start = len(UTF8_BOM)
+    table = CueTable(text=buf)
+    pos = start
+    for m in CUE_BLOCK_PATTERN.finditer(buf, start, end):
+        if m.start() > pos and buf[pos:m.start()].strip():
+            raise ValueError("Bad srt block at {}".format(pos))
+        g = m.groups()
+        if b"JSON:" in g[9]:
+            table.extras[len(table.no)] = intern_json(g[9].split(b"JSON:")[1].strip())
+        table.no.append(int(g[0]))
+        table.start_ms.append(to_milliseconds(g[1], g[2], g[3], g[4]))
+        table.end_ms.append(to_milliseconds(g[5], g[6], g[7], g[8]))
+        table.text_start.append(m.start(11))
+        table.text_end.append(m.end(11))
+        pos = m.end()
+    if buf[pos:end].strip():
+        raise ValueError("Bad srt block at {}".format(pos))
+    return table
+
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+BLANK_LINE_PATTERN = re.compile(br"\r?\n\r?\n")
+
+
+def read_srt_parallel(
+    path, processes=None, chunk_size=DEFAULT_CHUNK_SIZE, renumber=False
+):
+    """
+    巨大な字幕ファイルを空行の位置でチャンクに分割し、複数プロセスで並列に解析する
+
+    各プロセスはファイルをメモリマップして担当範囲を走査し、字幕の位置情報だけを返す。
+    結果はファイル内の順序で連結する。multiprocessingを使うため、Blender内ではなく
+    ヘッドレスのバッチ処理から呼び出すこと。
+
+    :param str path: 字幕ファイル(SubRip形式)のパス
+    :param int processes: プロセス数。Noneの場合はCPUのコア数
+    :param int chunk_size: 1チャンクのおおよそのバイト数
+    :param bool renumber: Trueの場合、noを1からの連番に振り直す
+    :return CueTable (textはmmap)
+    """
+    buf = map_srt_file(path)
+    if buf is None:
+        return CueTable()
+    if len(buf) <= chunk_size:
+        table = scan_cues(buf)
+        if renumber:
+            table.no = array("l", range(1, len(table.no) + 1))
+        return attach_style_table(table, path)
+
+    chunks = [(path, start, end) for start, end in split_chunks(buf, chunk_size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_scan_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    table = CueTable(text=buf)
+    for no, start_ms, end_ms, text_start, text_end, extras in results:
+        base = len(table.no)
+        for i, raw in extras.items():
+            table.extras[base + i] = intern_json(raw)
+        table.no.extend(no)
+        table.start_ms.extend(start_ms)
+        table.end_ms.extend(end_ms)
+        table.text_start.extend(text_start)
+        table.text_end.extend(text_end)
+    if renumber:
+        table.no = array("l", range(1, len(table.no) + 1))
+    return attach_style_table(table, path)
+
+
+def split_chunks(buf, chunk_size):
+    """
+    バイト列をおよそchunk_sizeごとに、空行の直後で区切った(開始, 終了)の配列を返す
+    """
+    chunks = []
+    start = 0
+    end_of_buf = len(buf)
+    while start < end_of_buf:
+        m = BLANK_LINE_PATTERN.search(buf, min(start + chunk_size, end_of_buf))
+        end = m.end() if m else end_of_buf
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def _scan_chunk(args):
+    path, start, end = args
+    buf = map_srt_file(path)
+    try:
+        table = scan_cues(buf, start, end)
+        extras = dict((i, json_data.raw) for i, json_data in table.extras.items())
+        return (
+            table.no,
+            table.start_ms,
+            table.end_ms,
+            table.text_start,
+            table.text_end,
+            extras,
+        )
+    finally:
+        buf.close()
+
+
+IngestResult = namedtuple("IngestResult", ["path", "table", "error"])
+
+
+def find_srt_files(targets):
+    """
+    ディレクトリ(サブディレクトリを含む)やglobパターンから字幕ファイルを列挙する
+
+    :param targets: ディレクトリ、globパターン、ファイルパス、またはそれらの配列
+    :return 字幕ファイルのパスの配列(重複なし、ソート済み)
+    """
+    if isinstance(targets, (str, text_type)):
+        targets = [targets]
+    paths = set()
+    for target in targets:
+        if os.path.isdir(target):
+            for dir_path, _, file_names in os.walk(target):
+                for file_name in fnmatch.filter(file_names, "*.srt"):
+                    paths.add(os.path.join(dir_path, file_name))
+        else:
+            paths.update(p for p in glob.glob(target) if os.path.isfile(p))
+    return sorted(paths)
+
+
+def ingest_srt_files(targets, processes=None):
+    """
+    複数の字幕ファイルを、プロセスプールで並列に読み込む
+
+    読み込みに失敗したファイルがあっても処理を続け、ファイルごとの結果を返す。
+    multiprocessingを使うため、ヘッドレスのバッチ処理から呼び出すこと。
+
+    :param targets: find_srt_filesに渡す、ディレクトリやglobパターン
+    :param int processes: プロセス数。Noneの場合はCPUのコア数
+    :return IngestResult(path, table, error)の配列(パス順)
+            成功した場合はtableにCueTable、失敗した場合はerrorにエラー内容を設定
+    """
+    paths = find_srt_files(targets)
+    if len(paths) <= 1:
+        return [_ingest_srt_file(path) for path in paths]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return list(pool.imap(_ingest_srt_file, paths))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _ingest_srt_file(path):
+    try:
+        return IngestResult(path, read_srt_file(path, as_table=True), None)
+    except Exception as e:
+        return IngestResult(path, None, "{}: {}".format(type(e).__name__, e))
+
+
+text_type = type(u"")
+
+try:
+    # 字幕ファイル内の位置の列の型。"l"はWindowsでは32ビットで、2GiBを超えるファイルの
+    # 位置が溢れるため、64ビットの"q"を使う
+    array("q")
+    OFFSET_TYPECODE = "q"
+except ValueError:
+    # GIMP(Python 2)のarrayは"q"に対応していない
+    OFFSET_TYPECODE = "l"
+
+
+class CueTable(object):
+    """
+    字幕を列指向で保持する表
+
+    no/start_ms/end_msはarrayの列、字幕文字列は全字幕を連結した1つの文字列と
+    そのオフセットで保持する。字幕個別の設定(json)は、持つ字幕の分だけ保持する。
+    style_tableがある場合、字幕個別の設定のスタイル参照は参照時に展開する。
+    """
+
+    def __init__(
+        self,
+        no=None,
+        start_ms=None,
+        end_ms=None,
+        text=u"",
+        text_start=None,
+        text_end=None,
+        extras=None,
+        digests=None,
+    ):
+        self.no = no if no is not None else array("l")
+        self.start_ms = start_ms if start_ms is not None else array("l")
+        self.end_ms = end_ms if end_ms is not None else array("l")
+        # 字幕iの文字列は text[text_start[i]:text_end[i]] (行は"\n"区切り)
+        # textがbytes(mmap含む)の場合は、参照時にUTF-8でデコードする
+        self.text = text
+        if text_start is None:
+            text_start = array(OFFSET_TYPECODE)
+        if text_end is None:
+            text_end = array(OFFSET_TYPECODE)
+        self.text_start = text_start
+        self.text_end = text_end
+        # 字幕のindex -> 字幕個別の設定
+        self.extras = extras if extras is not None else {}
+        # 字幕ブロックのハッシュ値(DIGEST_SIZEバイトずつ連結)。計算しない場合はNone
+        self.digests = digests
+        # スタイル参照を展開するスタイル表(attach_style_tableで設定する)
+        self.style_table = None
+        # スタイル表に見つからなかったスタイルID
+        self.missing_style_ids = set()
+        self._expanded_json = {}
+
+    @classmethod
+    def from_blocks(cls, blocks, with_digests=False):
+        """
+        iter_srt_blocksが返す字幕ブロックから表を作成する
+
+        :param bool with_digests: Trueの場合、字幕ブロックのハッシュ値も保持する
+        """
+        table = cls()
+        if with_digests:
+            table.digests = bytearray()
+        texts = []
+        pos = 0
+        for block in blocks:
+            if len(block) < 2 or "-->" not in block[1]:
+                raise ValueError("Bad time format:{}".format(block))
+            if with_digests:
+                table.digests += block_hash(block).digest()
+            time_info = parse_line_of_time(block[1], with_timedelta=False)
+            if "json" in time_info:
+                table.extras[len(table.no)] = time_info["json"]
+            table.no.append(int(block[0]))
+            table.start_ms.append(time_info["start_ms"])
+            table.end_ms.append(time_info["end_ms"])
+            text = u"\n".join(block[2:])
+            texts.append(text)
+            table.text_start.append(pos)
+            pos += len(text)
+            table.text_end.append(pos)
+        table.text = u"".join(texts)
+        return table
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        read_srt_file形式のitemから表を作成する
+        """
+        table = cls()
+        texts = []
+        pos = 0
+        for item in items:
+            time_info = item["time_info"]
+            if "json" in time_info:
+                table.extras[len(table.no)] = time_info["json"]
+            table.no.append(item["no"])
+            table.start_ms.append(time_info["start_ms"])
+            table.end_ms.append(time_info["end_ms"])
+            text = u"\n".join(item.get("lines", []))
+            texts.append(text)
+            table.text_start.append(pos)
+            pos += len(text)
+            table.text_end.append(pos)
+        table.text = u"".join(texts)
+        return table
+
+    def __len__(self):
+        return len(self.no)
+
+    def __iter__(self):
+        for i in range(len(self.no)):
+            yield Cue(self, i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.no))
+            if step != 1:
+                raise ValueError("CueTable does not support slice step")
+            return self.slice(start, stop)
+        if index < 0:
+            index += len(self.no)
+        if not 0 <= index < len(self.no):
+            raise IndexError("CueTable index out of range")
+        return Cue(self, index)
+
+    def slice(self, start, stop):
+        """
+        start以上stop未満の字幕の表を返す (文字列のバッファは共有する)
+        """
+        stop = max(start, stop)
+        extras = {}
+        if stop - start <= len(self.extras):
+            # extrasは字幕のindexをキーにしているため、範囲内の字幕だけを調べる
+            for i in range(start, stop):
+                json_data = self.extras.get(i)
+                if json_data is not None:
+                    extras[i - start] = json_data
+        else:
+            for i, json_data in self.extras.items():
+                if start <= i < stop:
+                    extras[i - start] = json_data
+        table = CueTable(
+            self.no[start:stop],
+            self.start_ms[start:stop],
+            self.end_ms[start:stop],
+            self.text,
+            self.text_start[start:stop],
+            self.text_end[start:stop],
+            extras,
+            None
+            if self.digests is None
+            else self.digests[start * DIGEST_SIZE:stop * DIGEST_SIZE],
+        )
+        table.style_table = self.style_table
+        table.missing_style_ids = self.missing_style_ids
+        table._expanded_json = self._expanded_json
+        return table
+
+    def between(self, start_ms, end_ms):
+        """
+        開始時刻がstart_ms以上end_ms未満の字幕の表を返す
+
+        字幕が開始時刻順に並んでいることを前提とする
+        """
+        start = bisect_left(self.start_ms, start_ms)
+        stop = bisect_left(self.start_ms, end_ms, start)
+        return self.slice(start, stop)
+
+    def json_of(self, index):
+        json_data = self.extras.get(index)
+        if (
+            json_data is None
+            or self.style_table is None
+            or STYLE_REF_KEY not in json_data
+        ):
+            return json_data
+        # 同じ設定(JSON文字列)は1回だけ展開する
+        raw = getattr(json_data, "raw", None)
+        expanded = self._expanded_json.get(raw) if raw is not None else None
+        if expanded is None:
+            expanded = expand_style_ref(
+                json_data, self.style_table, self.missing_style_ids
+            )
+            if raw is not None:
+                self._expanded_json[raw] = expanded
+        return expanded
+
+    def digest_of(self, index):
+        if self.digests is None:
+            return None
+        begin = index * DIGEST_SIZE
+        return binascii.hexlify(self.digests[begin:begin + DIGEST_SIZE]).decode("ascii")
+
+    def text_of(self, index):
+        text = self.text[self.text_start[index]:self.text_end[index]]
+        if isinstance(text, text_type):
+            return text
+        return text.decode("utf-8").replace(u"\r\n", u"\n")
+
+    def to_items(self):
+        return [cue.to_item() for cue in self]
+
+
+class Cue(object):
+    """
+    CueTableの1字幕を参照するビュー
+
+    read_srt_fileのitemと同様に cue["no"], cue["time_info"], cue["lines"]
+    でも参照できる
+    """
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def no(self):
+        return self.table.no[self.index]
+
+    @property
+    def start_ms(self):
+        return self.table.start_ms[self.index]
+
+    @property
+    def end_ms(self):
+        return self.table.end_ms[self.index]
+
+    @property
+    def text(self):
+        return self.table.text_of(self.index)
+
+    @property
+    def lines(self):
+        text = self.text
+        return text.split(u"\n") if text else []
+
+    @property
+    def json(self):
+        return self.table.json_of(self.index)
+
+    @property
+    def digest(self):
+        return self.table.digest_of(self.index)
+
+    @property
+    def time_info(self):
+        results = {
+            "start_ms": self.start_ms,
+            "end_ms": self.end_ms,
+            "start": ms_to_timedelta(self.start_ms),
+            "end": ms_to_timedelta(self.end_ms),
+        }
+        json_data = self.json
+        if json_data is not None:
+            results["json"] = json_data
+        return results
+
+    def __getitem__(self, key):
+        if key not in ("no", "time_info", "lines"):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in ("no", "time_info", "lines")
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def to_item(self):
+        item = {"no": self.no, "time_info": self.time_info}
+        lines = self.lines
+        if lines:
+            item["lines"] = lines
+        return item
+
+    def __repr__(self):
+        return "Cue(no={}, start_ms={}, end_ms={})".format(
+            self.no, self.start_ms, self.end_ms
+        )
+
+
+class LazyJson(Mapping):
+    """
+    字幕個別の設定(JSON文字列)を、初回参照時にデコードするdict互換オブジェクト
+
+    同じJSON文字列のオブジェクトはintern_jsonで共有されるため、参照専用として扱うこと
+    """
+
+    _NOT_DECODED = object()
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._data = self._NOT_DECODED
+
+    @property
+    def data(self):
+        if self._data is self._NOT_DECODED:
+            raw = self.raw
+            if not isinstance(raw, text_type):
+                raw = raw.decode("utf-8")
+            self._data = json.loads(raw)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "LazyJson({!r})".format(self.raw)
+
+    def __reduce__(self):
+        return (intern_json, (self.raw,))
+
+
+MAX_INTERNED_JSON = 1024
+_interned_json = {}
+
+
+def intern_json(raw):
+    """
+    JSON文字列に対応するLazyJsonを返す。同じ文字列には同じオブジェクトを返す
+
+    :param raw: JSON文字列(str/bytes)
+    :return LazyJson
+    """
+    obj = _interned_json.get(raw)
+    if obj is None:
+        if len(_interned_json) >= MAX_INTERNED_JSON:
+            _interned_json.clear()
+        obj = _interned_json[raw] = LazyJson(raw)
+    return obj
+
+
+# スタイル表(字幕ファイルと同じディレクトリのサイドカーファイル)
+STYLE_TABLE_SUFFIX = ".styles.json"
+# 字幕個別の設定で、スタイル表のスタイルを参照するキー
+STYLE_REF_KEY = "style_id"
+# スタイル表に含めない、字幕個別の設定のキー
+NON_STYLE_KEYS = ("settings",)
+
+
+def get_style_table_path(srt_path):
+    return srt_path + STYLE_TABLE_SUFFIX
+
+
+def read_style_table(srt_path):
+    """
+    字幕ファイルのスタイル表を読み込む
+
+    :param str srt_path: 字幕ファイルのパス
+    :return スタイルIDからスタイル(dict)への辞書。スタイル表がない場合は空の辞書
+    """
+    try:
+        with open(get_style_table_path(srt_path), encoding="utf-8") as f:
+            return json.load(f).get("styles", {})
+    except (IOError, OSError):
+        return {}
+
+
+def attach_style_table(table, srt_path):
+    """
+    字幕ファイルのスタイル表を読み込み、CueTableの字幕個別の設定のスタイル参照を
+    展開して返すようにする (字幕ファイルを読み込む関数は全てこれを通す)
+
+    :param CueTable table: 字幕ファイルから読み込んだ表
+    :param str srt_path: 字幕ファイルのパス
+    :return table
+    """
+    table.style_table = read_style_table(srt_path)
+    return table
+
+
+def write_style_table(srt_path, style_table):
+    """
+    字幕ファイルのスタイル表を書き込む(一時ファイルに書いてから置き換える)
+
+    :param str srt_path: 字幕ファイルのパス
+    :param dict style_table: スタイルIDからスタイル(dict)への辞書
+    """
+    table_path = get_style_table_path(srt_path)
+    data = json.dumps({"styles": style_table}, sort_keys=True, indent=2)
+    if isinstance(data, text_type):
+        data = data.encode("utf-8")
+    with my_files.atomic_write(table_path) as f:
+        f.write(data)
+
+
+def get_style_id(style):
+    """
+    スタイルの内容から決まるスタイルIDを返す
+
+    :param dict style: スタイル
+    :return str スタイルID
+    """
+    data = json.dumps(style, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()[:12]
+
+
+def make_style_ref(data, style_table):
+    """
+    字幕個別の設定のスタイルをスタイル表に登録し、スタイルIDで参照する設定を返す
+
+    :param dict data: 字幕個別の設定(スタイルを含む)
+    :param dict style_table: スタイルを登録するスタイル表
+    :return スタイルの代わりにスタイルIDを含む設定
+            (スタイルを含まない場合はdataをそのまま返す。スタイルIDはSTYLE_REF_KEYの値)
+    """
+    style = dict((k, v) for k, v in data.items() if k not in NON_STYLE_KEYS)
+    if not style:
+        return data
+    style_id = get_style_id(style)
+    style_table.setdefault(style_id, style)
+    ref = dict((k, v) for k, v in data.items() if k in NON_STYLE_KEYS)
+    ref[STYLE_REF_KEY] = style_id
+    return ref
+
+
+def expand_style_ref(data, style_table, missing_ids=None):
+    """
+    スタイルIDで参照している字幕個別の設定を、スタイルを含む設定に展開する
+
+    スタイルIDを含まない設定はそのまま返す。
+    スタイル表にないスタイルIDの場合は、スタイルを含まない設定(既定のスタイルを使う)を返す
+
+    :param data: 字幕個別の設定(dict/LazyJson)
+    :param dict style_table: read_style_tableで読み込んだスタイル表
+    :param set missing_ids: スタイル表にないスタイルIDを追加する集合
+    :return スタイルを含む設定
+    """
+    if STYLE_REF_KEY not in data:
+        return data
+    style_id = data[STYLE_REF_KEY]
+    if style_id not in style_table:
+        if missing_ids is not None:
+            missing_ids.add(style_id)
+        return dict((k, v) for k, v in data.items() if k != STYLE_REF_KEY)
+    expanded = dict(style_table[style_id])
+    for key, value in data.items():
+        if key != STYLE_REF_KEY:
+            expanded[key] = value
+    return expanded
+
+
+def resolve_style_refs(items, style_table, missing_ids=None):
+    """
+    字幕データの個別の設定のスタイル参照を展開する
+
+    同じ設定(JSON文字列)は1回だけ展開するため、展開の回数はスタイルの種類数に比例する
+
+    :param items: iter_srt_fileなどが返す字幕データ
+    :param dict style_table: read_style_tableで読み込んだスタイル表
+    :param set missing_ids: スタイル表にないスタイルIDを追加する集合
+    :return 字幕データを返すイテレーター
+    """
+    expanded = {}
+    for item in items:
+        data = item["time_info"].get("json")
+        if data is not None and STYLE_REF_KEY in data:
+            raw = getattr(data, "raw", None)
+            if raw is None:
+                item["time_info"]["json"] = expand_style_ref(
+                    data, style_table, missing_ids
+                )
+            else:
+                if raw not in expanded:
+                    expanded[raw] = expand_style_ref(data, style_table, missing_ids)
+                item["time_info"]["json"] = expanded[raw]
+        yield item
+
+
+TIME_LINE_PATTERN = re.compile(
+    r"\A(\d+):(\d+):(\d+),(\d+) *--> *(\d+):(\d+):(\d+),(\d+) *(.+)?"
+)
+TIMESTAMP_PATTERN = re.compile(r"\A(\d+):(\d+):(\d+),(\d+)\Z")
+
+
+def to_milliseconds(hours, minutes, seconds, fraction):
+    # strptimeの%fと同様に、桁数が足りない小数部は右側を0埋めして扱う
+    fraction = fraction[:3]
+    millis = int(fraction) * 10 ** (3 - len(fraction))
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + millis
+
+
+def parse_timestamp(t):
+    """
+    SubRip形式のタイムスタンプ(HH:MM:SS,mmm)をミリ秒の整数に変換する
+
+    :param str t: タイムスタンプ文字列
+    :return int ミリ秒
+    """
+    m = TIMESTAMP_PATTERN.match(t)
+    if not m:
+        raise ValueError("Bad timestamp format:{}".format(t))
+    return to_milliseconds(*m.groups())
+
+
+def ms_to_timedelta(ms):
+    return timedelta(milliseconds=ms)
+
+
+def parse_line_of_time(line, with_timedelta=True):
+    """
+    タイムコード行を解析する
+
+    :param str line: タイムコード行
+    :param bool with_timedelta: Trueの場合、start/endにtimedeltaも設定する
+    :return {"start_ms": int, "end_ms": int,
+             "start": timedelta, "end": timedelta,
+             "json": 字幕個別の設定(存在する場合のみ。LazyJson)}
+            行の形式が不正な場合は空のdict
+    """
+    m = TIME_LINE_PATTERN.match(line)
     results = {}
     if m:
-        for k, t in [["start", m.group(1)], ["end", m.group(2)]]:
-            if t:
-                results[k] = time_to_delta(datetime.strptime(t, "%H:%M:%S,%f"))
-            else:
-                results[k] = None
-        if m.group(3):
-            extras = m.group(3)
+        g = m.groups()
+        results["start_ms"] = to_milliseconds(g[0], g[1], g[2], g[3])
+        results["end_ms"] = to_milliseconds(g[4], g[5], g[6], g[7])
+        if with_timedelta:
+            results["start"] = ms_to_timedelta(results["start_ms"])
+            results["end"] = ms_to_timedelta(results["end_ms"])
+        if g[8]:
+            extras = g[8]
             if "JSON:" in extras:
-                json_data = json.loads(extras.split("JSON:")[1].strip())
-                results["json"] = json_data
+                results["json"] = intern_json(extras.split("JSON:")[1].strip())
         return results
     else:
         return results
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict, namedtuple
+
+# StyleCompilerが保持するコンパイル結果の最大数
+DEFAULT_STYLE_CACHE_SIZE = 256
+
+
+class BorderStyle(namedtuple("BorderStyle", ["color", "grow", "feather"])):
+    """
+    縁取りのスタイル
+
+    grow: 選択範囲の拡大幅(単位: px)
+    feather: 選択範囲のぼかし幅(単位: px)。0の場合はぼかさない
+    """
+
+    __slots__ = ()
+
+
+class ShadowStyle(
+    namedtuple(
+        "ShadowStyle", ["color", "offset_x", "offset_y", "blur_radius", "opacity"]
+    )
+):
+    """
+    影のスタイル
+
+    opacity: 影の不透明度(0〜1)
+    """
+
+    __slots__ = ()
+
+
+class BoxStyle(namedtuple("BoxStyle", ["color", "opacity", "padding_x", "padding_y"])):
+    """
+    ボックスのスタイル
+
+    opacity: ボックスの不透明度(0〜100)
+    """
+
+    __slots__ = ()
+
+
+class CompiledStyle(
+    namedtuple(
+        "CompiledStyle",
+        [
+            "font_family",
+            "font_size",
+            "text_color",
+            "justify",
+            "line_spacing",
+            "canvas_padding_x",
+            "canvas_padding_y",
+            "borders",
+            "shadow",
+            "box",
+            "crop_padding_x",
+            "crop_padding_y",
+        ],
+    )
+):
+    """
+    字幕画像の作成に必要な値を計算済みのスタイル
+
+    変更できず、ハッシュ値を持つため、キャッシュのキーとして使える。
+
+    line_spacing: 行間の調整幅(単位: px)
+    canvas_padding_x, canvas_padding_y: テキストの周囲の余白(単位: px)
+    borders: 縁取りのスタイル(BorderStyle)のタプル。設定がない縁取りはNone
+    shadow: 影のスタイル(ShadowStyle)。影を使わない場合はNone
+    box: ボックスのスタイル(BoxStyle)。ボックスを使わない場合はNone
+    crop_padding_x, crop_padding_y: 切り抜き時の余白(単位: px)
+    """
+
+    __slots__ = ()
+
+
+def _as_is(value):
+    return value
+
+
+def compile_style(settings, max_borders=None, resolve_justify=None, encode=None):
+    """
+    マージ済みの設定をCompiledStyleに変換する
+
+    :param dict settings: マージ済みの設定
+    :param int max_borders: 縁取りの最大数。Noneの場合は制限しない
+    :param resolve_justify: 文字揃えの名前("left"など)を描画側の値に変換する関数
+    :param encode: 色やフォント名の文字列を描画側の文字列に変換する関数
+    :return CompiledStyle
+    """
+    resolve_justify = resolve_justify or _as_is
+    encode = encode or _as_is
+    styles = settings["styles"]
+    text = styles["text"]
+    font_size = text["size"]
+    canvas = settings["canvas"]
+
+    num_of_borders = settings["number_of_borders"]
+    if max_borders is not None:
+        num_of_borders = min(max_borders, num_of_borders)
+    border_settings = styles.get("borders", ())
+    borders = []
+    for i in range(num_of_borders):
+        border = border_settings[i] if i < len(border_settings) else None
+        if border:
+            border = BorderStyle(
+                encode(border["color"]),
+                font_size * border["rate"],
+                font_size * border["feather"],
+            )
+        borders.append(border or None)
+
+    shadow = None
+    shadow_setting = styles.get("shadow")
+    if settings["with_shadow"] and shadow_setting:
+        shadow = ShadowStyle(
+            encode(shadow_setting["color"]),
+            shadow_setting["offset_x"],
+            shadow_setting["offset_y"],
+            shadow_setting["blur_radius"],
+            shadow_setting.get("opacity", 1.0),
+        )
+
+    box = None
+    box_setting = styles.get("box")
+    if settings["with_box"] and box_setting:
+        box = BoxStyle(
+            encode(box_setting["color"]),
+            box_setting["opacity"] * 100,
+            box_setting["padding_x"],
+            box_setting["padding_y"],
+        )
+
+    crop_area = settings["crop_area"]
+    return CompiledStyle(
+        encode(text["font_family"]),
+        font_size,
+        encode(text["color"]),
+        resolve_justify(text["align"]),
+        font_size * text["line_space_rate"],
+        font_size * canvas["padding_x_rate"],
+        font_size * canvas["padding_y_rate"],
+        tuple(borders),
+        shadow,
+        box,
+        crop_area["padding_x"],
+        crop_area["padding_y"],
+    )
+
+
+class StyleCompiler(object):
+    """
+    マージ済みの設定ごとにCompiledStyleをキャッシュする
+
+    同じ設定オブジェクト(SettingsMergerのマージ結果)は1回だけコンパイルし、
+    内容が同じCompiledStyleは同じオブジェクトを返す。
+    """
+
+    def __init__(
+        self,
+        max_borders=None,
+        resolve_justify=None,
+        encode=None,
+        maxsize=DEFAULT_STYLE_CACHE_SIZE,
+    ):
+        self.max_borders = max_borders
+        self.resolve_justify = resolve_justify
+        self.encode = encode
+        self.maxsize = maxsize
+        # id(設定) -> (設定, CompiledStyle)。idの再利用を防ぐため設定も保持する
+        self._cache = OrderedDict()
+        self._interned = {}
+
+    def compile(self, settings):
+        key = id(settings)
+        entry = self._cache.pop(key, None)
+        if entry is None:
+            style = compile_style(
+                settings, self.max_borders, self.resolve_justify, self.encode
+            )
+            if len(self._interned) >= self.maxsize:
+                self._interned.clear()
+            style = self._interned.setdefault(style, style)
+            entry = (settings, style)
+            if len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+        self._cache[key] = entry
+        return entry[1]
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import heapq
+from collections import namedtuple
+
+# 字幕間の最小の間隔(単位: ms)
+DEFAULT_MIN_GAP_MS = 80
+# 1秒あたりの最大文字数
+DEFAULT_MAX_CPS = 20.0
+
+# 違反の種類
+OVERLAP = "overlap"
+SHORT_GAP = "gap"
+BAD_DURATION = "duration"
+TOO_FAST = "cps"
+
+KIND_ORDER = {OVERLAP: 0, SHORT_GAP: 1, BAD_DURATION: 2, TOO_FAST: 3}
+
+# 字幕の区間。lint_timelineには、start_ms, end_ms, text属性を持つ
+# オブジェクト(my_srt.Cueなど)であれば、このクラス以外も渡せる
+Span = namedtuple("Span", ["start_ms", "end_ms", "text"])
+
+# 違反内容
+#   kind: 違反の種類
+#   index: 違反した字幕のインデックス(入力順)
+#   other: 重なり、間隔の相手となる字幕のインデックス。ない場合はNone
+#   start_ms, end_ms: 違反した区間
+#   value: 重なり・間隔の長さ(ms)、または1秒あたりの文字数
+Violation = namedtuple(
+    "Violation", ["kind", "index", "other", "start_ms", "end_ms", "value"]
+)
+
+
+def count_chars(text):
+    """
+    読む文字数を数える(改行は含めない)
+
+    :param str text: 字幕のテキスト
+    :return 文字数
+    """
+    return len(text) - text.count("\n")
+
+
+def lint_timeline(cues, min_gap_ms=DEFAULT_MIN_GAP_MS, max_cps=DEFAULT_MAX_CPS):
+    """
+    字幕の重なり、短すぎる間隔、読む速度の超過を検出する
+
+    字幕を開始時刻でソートし、表示中の字幕の終了時刻をヒープで管理しながら
+    1回走査する。計算量は O(n log n + 違反数)。
+
+    my_srt.CueTableをそのまま渡せる:
+        lint_timeline(my_srt.read_srt_file(path, as_table=True))
+
+    :param cues: start_ms, end_ms, text属性を持つ字幕の配列
+    :param int min_gap_ms: 字幕間の最小の間隔。0の場合、間隔を検査しない
+    :param float max_cps: 1秒あたりの最大文字数。0の場合、速度を検査しない
+    :return 違反内容(Violation)の配列(開始時刻順)
+    """
+    spans = [(c.start_ms, c.end_ms, c.text) for c in cues]
+    order = sorted(range(len(spans)), key=lambda i: (spans[i][0], spans[i][1], i))
+    violations = []
+    # 表示中の字幕(終了時刻, インデックス)
+    active = []
+    # 直前までに表示された字幕の最も遅い終了時刻とそのインデックス
+    last_end = None
+    last_index = None
+    for i in order:
+        start_ms, end_ms, text = spans[i]
+        while active and active[0][0] <= start_ms:
+            heapq.heappop(active)
+        duration = end_ms - start_ms
+        if duration > 0:
+            for other_end, other in active:
+                overlap_end = min(end_ms, other_end)
+                violations.append(
+                    Violation(
+                        OVERLAP, i, other, start_ms, overlap_end, overlap_end - start_ms
+                    )
+                )
+        if last_end is not None and min_gap_ms > 0:
+            gap = start_ms - last_end
+            if 0 <= gap < min_gap_ms:
+                violations.append(
+                    Violation(SHORT_GAP, i, last_index, last_end, start_ms, gap)
+                )
+
+        if duration <= 0:
+            violations.append(
+                Violation(BAD_DURATION, i, None, start_ms, end_ms, duration)
+            )
+        else:
+            heapq.heappush(active, (end_ms, i))
+            if max_cps > 0:
+                cps = count_chars(text) * 1000.0 / duration
+                if cps > max_cps:
+                    violations.append(
+                        Violation(TOO_FAST, i, None, start_ms, end_ms, cps)
+                    )
+
+        if last_end is None or end_ms > last_end:
+            last_end = end_ms
+            last_index = i
+
+    violations.sort(key=lambda v: (v.start_ms, v.index, KIND_ORDER[v.kind]))
+    return violations
+
+
+def format_ms(ms):
+    sign = "-" if ms < 0 else ""
+    s, ms = divmod(abs(int(ms)), 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return "{}{:02}:{:02}:{:02},{:03}".format(sign, h, m, s, ms)
+
+
+def describe_violation(v, numbers=None):
+    """
+    違反内容を説明する文字列を返す
+
+    :param Violation v: 違反内容
+    :param numbers: インデックスから字幕番号への変換表。Noneの場合、インデックスを表示
+    :return 説明文
+    """
+
+    def no(i):
+        return numbers[i] if numbers is not None else i
+
+    span = "{} --> {}".format(format_ms(v.start_ms), format_ms(v.end_ms))
+    if v.kind == OVERLAP:
+        return "{}: 字幕{}と字幕{}が{}ms重なっています".format(
+            span, no(v.other), no(v.index), v.value
+        )
+    elif v.kind == SHORT_GAP:
+        return "{}: 字幕{}と字幕{}の間隔が{}msしかありません".format(
+            span, no(v.other), no(v.index), v.value
+        )
+    elif v.kind == BAD_DURATION:
+        return "{}: 字幕{}の表示時間が{}msです".format(span, no(v.index), v.value)
+    else:
+        return "{}: 字幕{}が1秒あたり{:.1f}文字あります".format(span, no(v.index), v.value)
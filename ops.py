@@ -2,15 +2,22 @@ from typing import Set
 import bpy
 import os
 import datetime
-import shutil
-import subprocess
 import json
 import logging
+import threading
+import time
+from collections import namedtuple
 
 from bpy.types import Context, Event
 from . import my_srt
+from . import props
+from . import my_timeline
+from . import my_layout
 from . import utils
 from . import my_settings
+from . import gimp_server
+from . import pil_renderer
+from . import render_shard
 
 
 class StrLoaderGetTimestampOfPlayhead(bpy.types.Operator):
@@ -76,21 +83,19 @@ class SrtLoaderSaveSrtFile(bpy.types.Operator):
 
     def execute(self, context: Context) -> Set[str] | Set[int]:
         srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
-        logging.debug(utils.jimakulist_to_srtdata(srtloarder_jimaku.list))
         srtloarder_settings = bpy.data.objects[0].srtloarder_settings
         output_path = bpy.path.abspath(srtloarder_settings.srt_file)
-        dir_path = os.path.dirname(output_path)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-
-        if os.path.exists(output_path):
-            # backup
-            shutil.copyfile(output_path, output_path + ".bk")
-
-        with open(output_path, mode="w") as f:
-            srt_data = utils.jimakulist_to_srtdata(srtloarder_jimaku.list)
-            for data in srt_data:
-                f.write(f"{data}\n")
+        # 自動保存中の場合は、古い内容で上書きされないように完了を待つ
+        SrtLoaderAutoSaveSrtFile.wait_for_saving()
+        use_style_table = srtloarder_settings.use_style_table
+        block_key = get_saved_block_key(output_path, use_style_table)
+        saved_blocks = write_jimaku_snapshot(
+            output_path,
+            snapshot_jimaku_list(srtloarder_jimaku, block_key, use_style_table),
+            use_style_table,
+        )
+        apply_saved_blocks(srtloarder_jimaku, block_key, saved_blocks)
+        SrtLoaderAutoSaveSrtFile.last_saved_at = datetime.datetime.now()
         bpy.data.objects[0].srtloarder_jimaku.jimaku_data_changed = False
         self.report(
             type={"INFO"},
@@ -99,6 +104,257 @@ class SrtLoaderSaveSrtFile(bpy.types.Operator):
         return {"FINISHED"}
 
 
+# 保存した字幕ブロックと、字幕ブロックが参照するスタイル表のスタイルID(参照しない場合はNone)
+SavedBlock = namedtuple("SavedBlock", ["block", "style_id"])
+
+
+class SavedBlockCache(object):
+    """
+    前回保存したSavedBlockを、字幕情報の変更番号(revision)をキーとして保持する
+
+    blendファイルには保存しないため、blendファイルを開いた後の最初の保存では全て作り直す。
+    字幕ブロックはスタイル表のスタイルIDと、フレームレートから計算した時刻を含むため、
+    保存先・スタイル表の使用・フレームレートが変わった場合は破棄する。
+    """
+
+    def __init__(self):
+        self.key = None
+        self.blocks = {}
+
+    def get_blocks(self, key):
+        if key != self.key:
+            self.key = key
+            self.blocks = {}
+        return self.blocks
+
+    def clear(self):
+        self.key = None
+        self.blocks = {}
+
+
+saved_block_cache = SavedBlockCache()
+
+
+def get_saved_block_key(output_path, use_style_table):
+    return (output_path, use_style_table, utils.get_frame_rate())
+
+
+def snapshot_jimaku_list(jimaku_data, block_key, use_style_table=False):
+    """
+    保存用に、字幕情報のスナップショットをbpyに依存しないデータで作成する
+
+    前回保存時から変更のない字幕情報は前回保存したSavedBlock、
+    変更された字幕情報は(インデックス, 変更番号, jimaku_to_srt_snapshotのデータ)になる。
+    スナップショットを作るのは変更された字幕情報だけ。
+    """
+    blocks = saved_block_cache.get_blocks(block_key)
+    all_dirty = props.dirty_tracker.all_dirty
+    props.dirty_tracker.all_dirty = False
+    used_blocks = {}
+    entries = []
+    for idx, jimaku in enumerate(jimaku_data.list):
+        saved_block = None if all_dirty else blocks.get(jimaku.revision)
+        if saved_block is not None:
+            used_blocks[jimaku.revision] = saved_block
+            entries.append(saved_block)
+        else:
+            # 保存した字幕ブロックを記録するために、新しい変更番号にする
+            revision = props.dirty_tracker.mark(jimaku)
+            entries.append((idx, revision, utils.jimaku_to_srt_snapshot(jimaku)))
+    # 使われなくなった字幕ブロックを捨てる
+    saved_block_cache.blocks = used_blocks
+    return entries
+
+
+def write_jimaku_snapshot(output_path, entries, use_style_table=False):
+    """
+    スナップショットを字幕ファイルに書き出す (別スレッドから呼び出せる)
+
+    use_style_tableがTrueの場合、スタイルはスタイル表(サイドカーファイル)に1つずつ保存し、
+    字幕ブロックにはスタイルIDだけを書き込む
+
+    :return 作成した字幕ブロック [(インデックス, 変更番号, SavedBlock, ハッシュ値)]
+    """
+    dir_path = os.path.dirname(output_path)
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+
+    style_table = my_srt.read_style_table(output_path) if use_style_table else None
+    style_ids = set()
+    blocks = []
+    saved_blocks = []
+    for entry in entries:
+        if isinstance(entry, SavedBlock):
+            saved_block = entry
+        else:
+            idx, revision, snapshot = entry
+            style_id = None
+            if use_style_table:
+                no, start, end, json_data, text = snapshot
+                json_data = my_srt.make_style_ref(json_data, style_table)
+                style_id = json_data.get(my_srt.STYLE_REF_KEY)
+                snapshot = (no, start, end, json_data, text)
+            saved_block = SavedBlock(utils.snapshot_to_srt_block(snapshot), style_id)
+            digest = my_srt.block_text_digest(saved_block.block)
+            saved_blocks.append((idx, revision, saved_block, digest))
+        if saved_block.style_id is not None:
+            style_ids.add(saved_block.style_id)
+        blocks.append(saved_block.block)
+
+    if use_style_table:
+        # 字幕ファイルが参照するスタイルが常に存在するように、先にスタイル表を書き込む
+        my_srt.write_style_table(output_path, style_table)
+    utils.write_srt_file(output_path, blocks)
+    if use_style_table and not style_ids.issuperset(style_table):
+        # 参照されなくなったスタイルを削除する
+        used_styles = {k: v for k, v in style_table.items() if k in style_ids}
+        my_srt.write_style_table(output_path, used_styles)
+    return saved_blocks
+
+
+def apply_saved_blocks(jimaku_data, block_key, saved_blocks):
+    """
+    保存した字幕ブロックを、次回の保存で使い回せるように記録する
+
+    字幕ブロックのハッシュ値は次回の差分読み込みに使う
+    (スナップショット作成後に変更された字幕情報は除く)
+    """
+    blocks = saved_block_cache.get_blocks(block_key)
+    jimaku_list = jimaku_data.list
+    for idx, revision, saved_block, digest in saved_blocks:
+        blocks[revision] = saved_block
+        if idx < len(jimaku_list) and jimaku_list[idx].revision == revision:
+            jimaku_list[idx].source_hash = digest
+
+
+class SrtLoaderAutoSaveSrtFile(bpy.types.Operator):
+    bl_idname = "srt_loader.autosave_srt"
+    bl_label = "字幕ファイルの自動保存"
+    bl_description = "未保存の変更を、一定間隔でバックグラウンドで字幕ファイルに保存する"
+
+    # 自動保存中かどうか(blendファイルには保存しない)
+    autosaving = False
+    # 最後に字幕ファイルの保存に成功した日時と、最後の自動保存のエラー
+    last_saved_at = None
+    last_error = None
+    # 書き込み中の保存処理 {"thread", "block_key", "saved_blocks" or "error"}
+    saving_job = None
+    # modalが動作中かどうか(同時に1つだけ動作させる)
+    modal_running = False
+    _last_started = 0
+    _timer = None
+
+    @classmethod
+    def poll(cls, context):
+        srtloarder_settings = bpy.data.objects[0].srtloarder_settings
+        return bool(srtloarder_settings.srt_file)
+
+    @classmethod
+    def wait_for_saving(cls):
+        if cls.saving_job is not None:
+            cls.saving_job["thread"].join()
+
+    @classmethod
+    def get_status_text(cls):
+        if cls.last_error is not None:
+            return f"自動保存に失敗: {cls.last_error}"
+        elif cls.last_saved_at is not None:
+            return f"最終保存: {cls.last_saved_at:%H:%M:%S}"
+        else:
+            return None
+
+    @staticmethod
+    def save_in_background(output_path, entries, use_style_table, job):
+        try:
+            job["saved_blocks"] = write_jimaku_snapshot(
+                output_path, entries, use_style_table
+            )
+        except Exception as e:
+            job["error"] = e
+
+    @classmethod
+    def start_saving(cls):
+        srtloarder_settings = bpy.data.objects[0].srtloarder_settings
+        srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
+        output_path = bpy.path.abspath(srtloarder_settings.srt_file)
+        use_style_table = srtloarder_settings.use_style_table
+        block_key = get_saved_block_key(output_path, use_style_table)
+        entries = snapshot_jimaku_list(srtloarder_jimaku, block_key, use_style_table)
+        # 書き込み中の変更を検出できるように、先に変更フラグを下ろす
+        srtloarder_jimaku.jimaku_data_changed = False
+        job = {"block_key": block_key}
+        job["thread"] = threading.Thread(
+            target=cls.save_in_background,
+            args=(output_path, entries, use_style_table, job),
+            daemon=True,
+        )
+        cls.saving_job = job
+        cls._last_started = time.monotonic()
+        job["thread"].start()
+
+    @classmethod
+    def finish_saving(cls, context: Context):
+        job = cls.saving_job
+        cls.saving_job = None
+        srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
+        if "error" in job:
+            srtloarder_jimaku.jimaku_data_changed = True
+            cls.last_error = job["error"]
+            logging.error(f"autosave failed: {cls.last_error}")
+        else:
+            apply_saved_blocks(srtloarder_jimaku, job["block_key"], job["saved_blocks"])
+            cls.last_saved_at = datetime.datetime.now()
+            cls.last_error = None
+        for area in context.screen.areas:
+            area.tag_redraw()
+
+    def modal(self, context: Context, event: Event) -> Set[str] | Set[int]:
+        if event.type != "TIMER":
+            return {"PASS_THROUGH"}
+
+        cls = SrtLoaderAutoSaveSrtFile
+        if cls.saving_job is not None:
+            if cls.saving_job["thread"].is_alive():
+                return {"PASS_THROUGH"}
+            cls.finish_saving(context)
+
+        srtloarder_settings = bpy.data.objects[0].srtloarder_settings
+        if not cls.autosaving or not srtloarder_settings.srt_file:
+            context.window_manager.event_timer_remove(self._timer)
+            self._timer = None
+            cls.autosaving = False
+            cls.modal_running = False
+            return {"FINISHED"}
+
+        srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
+        elapsed = time.monotonic() - cls._last_started
+        if (
+            srtloarder_jimaku.jimaku_data_changed
+            and not srtloarder_jimaku.jimaku_editing
+            and elapsed >= srtloarder_settings.autosave_interval
+        ):
+            cls.start_saving()
+        return {"PASS_THROUGH"}
+
+    def invoke(self, context: Context, event: Event) -> Set[str] | Set[int]:
+        cls = SrtLoaderAutoSaveSrtFile
+        if cls.autosaving:
+            # 自動保存中の場合は停止する(書き込み完了後にmodalが終了する)
+            cls.autosaving = False
+            return {"FINISHED"}
+
+        cls.autosaving = True
+        if cls.modal_running:
+            # 停止待ちのmodalが残っている場合は、そのmodalで自動保存を続ける
+            return {"FINISHED"}
+
+        cls.modal_running = True
+        cls._last_started = time.monotonic()
+        self._timer = context.window_manager.event_timer_add(1.0, window=context.window)
+        context.window_manager.modal_handler_add(self)
+        return {"RUNNING_MODAL"}
+
+
 class SrtLoaderReadSrtFile(bpy.types.Operator):
     bl_idname = "srt_loader.read_srt"
     bl_label = "字幕ファイルを読み込む"
@@ -115,20 +371,7 @@ class SrtLoaderReadSrtFile(bpy.types.Operator):
 
     def load_jimaku(self, srt_path, jimaku_data):
         jimaku_data.list.clear()
-        items = my_srt.read_srt_file(srt_path)
-        fps = utils.get_frame_rate()
-        style_json_data = utils.get_default_style_json_data()
-        for item in items:
-            obj = jimaku_data.list.add()
-            obj.no = item["no"]
-            obj.text = "\n".join(item["lines"])
-            obj.start_frame = utils.timedelta_to_frame(item["time_info"]["start"], fps)
-            diff = item["time_info"]["end"] - item["time_info"]["start"]
-            obj.frame_duration = utils.timedelta_to_frame(diff, fps)
-            if "json" in item["time_info"]:
-                utils.update_jimaku(obj, item["time_info"]["json"])
-            else:
-                utils.update_styles(obj.styles, style_json_data, False)
+        return reload_jimaku(srt_path, jimaku_data)
 
     def execute(self, context: Context) -> Set[str] | Set[int]:
         srt_file = bpy.data.objects[0].srtloarder_settings.srt_file
@@ -147,11 +390,179 @@ class SrtLoaderReadSrtFile(bpy.types.Operator):
             return {"CANCELLED"}
 
         srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
-        self.load_jimaku(srt_path, srtloarder_jimaku)
+        if srtloarder_jimaku.jimaku_data_changed:
+            # 未保存の変更は破棄して読み込み直す
+            result = self.load_jimaku(srt_path, srtloarder_jimaku)
+        else:
+            result = reload_jimaku(srt_path, srtloarder_jimaku)
         srtloarder_jimaku.jimaku_data_changed = False
+        missing_style_ids = result[3]
+        if missing_style_ids:
+            self.report(
+                type={"WARNING"},
+                message="スタイル表にないスタイルを参照している字幕は既定のスタイルにしました: "
+                + ", ".join(sorted(missing_style_ids)),
+            )
         return {"FINISHED"}
 
 
+def update_jimaku_from_item(jimaku, item, fps, style_json_data):
+    with props.dirty_tracker.editing(jimaku):
+        jimaku.no = item["no"]
+        jimaku.text = "\n".join(item.get("lines", []))
+        jimaku.start_frame = utils.timedelta_to_frame(item["time_info"]["start"], fps)
+        diff = item["time_info"]["end"] - item["time_info"]["start"]
+        jimaku.frame_duration = utils.timedelta_to_frame(diff, fps)
+        json_data = item["time_info"].get("json")
+        if json_data is not None:
+            utils.update_jimaku(jimaku, json_data)
+        if json_data is None or "styles" not in json_data:
+            # スタイルを含まない(スタイル表にないスタイルを参照している場合を含む)字幕は
+            # 既定のスタイルにする
+            utils.update_styles(jimaku.styles, style_json_data, False)
+
+
+def read_cue_table(srt_path):
+    """
+    字幕ファイルをハッシュ値付きのCueTableとして読み込む (解析結果のキャッシュを利用する)
+    """
+    cache_dir = utils.get_srt_cache_dir()
+    if cache_dir is not None:
+        return my_srt.SrtParseCache(cache_dir).load(srt_path)
+    with open(srt_path, encoding="utf-8") as f:
+        blocks = my_srt.iter_srt_blocks(f)
+        table = my_srt.CueTable.from_blocks(blocks, with_digests=True)
+    return my_srt.attach_style_table(table, srt_path)
+
+
+def reload_jimaku(srt_path, jimaku_data):
+    """
+    字幕ファイルを差分読み込みする
+
+    字幕ブロックのハッシュ値を読み込み時のものと比較し、変更された字幕だけを追加・更新・削除する
+
+    :return (追加数, 更新数, 削除数, スタイル表に見つからなかったスタイルIDの集合)
+    """
+    jimaku_list = jimaku_data.list
+    fps = utils.get_frame_rate()
+    # 前回の読み込みからフレームレートが変わった場合は、全ての字幕のフレームを計算し直す
+    fps_changed = jimaku_data.source_fps != fps
+    style_json_data = None
+    existing = {jimaku.no: jimaku for jimaku in jimaku_list}
+    file_nos = []
+    added = updated = 0
+    table = read_cue_table(srt_path)
+    for cue in table:
+        digest = cue.digest
+        # 同じ番号の字幕が複数ある場合、2つ目以降は追加として扱う
+        jimaku = existing.pop(cue.no, None)
+        if jimaku is not None and jimaku.source_hash == digest and not fps_changed:
+            file_nos.append(jimaku.no)
+            continue
+        if jimaku is None:
+            jimaku = jimaku_list.add()
+            added += 1
+        else:
+            updated += 1
+        if style_json_data is None:
+            style_json_data = utils.get_default_style_json_data()
+        update_jimaku_from_item(jimaku, cue.to_item(), fps, style_json_data)
+        jimaku.source_hash = digest
+        file_nos.append(jimaku.no)
+
+    # ファイルから削除された字幕を削除
+    file_no_set = set(file_nos)
+    removed_indices = [
+        idx for idx, jimaku in enumerate(jimaku_list) if jimaku.no not in file_no_set
+    ]
+    for idx in reversed(removed_indices):
+        jimaku_list.remove(idx)
+
+    # ファイル内の順序に並べ替え
+    current_nos = [jimaku.no for jimaku in jimaku_list]
+    for target_idx, no in enumerate(file_nos):
+        if current_nos[target_idx] == no:
+            continue
+        idx = current_nos.index(no, target_idx + 1)
+        jimaku_list.move(idx, target_idx)
+        current_nos.insert(target_idx, current_nos.pop(idx))
+
+    jimaku_data.index = max(0, min(jimaku_data.index, len(jimaku_list) - 1))
+    jimaku_data.source_fps = fps
+    return (added, updated, len(removed_indices), table.missing_style_ids)
+
+
+class SrtLoaderWatchSrtFile(bpy.types.Operator):
+    bl_idname = "srt_loader.watch_srt"
+    bl_label = "字幕ファイルの監視"
+    bl_description = "字幕ファイルの変更を監視し、変更された字幕を自動で読み込む"
+
+    # 監視中かどうか(blendファイルには保存しない)
+    watching = False
+    _timer = None
+    _last_stat = None
+
+    @classmethod
+    def poll(cls, context):
+        srtloarder_settings = bpy.data.objects[0].srtloarder_settings
+        return bool(srtloarder_settings.srt_file)
+
+    def get_srt_stat(self):
+        srt_file = bpy.data.objects[0].srtloarder_settings.srt_file
+        try:
+            st = os.stat(bpy.path.abspath(srt_file))
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def modal(self, context: Context, event: Event) -> Set[str] | Set[int]:
+        srtloarder_settings = bpy.data.objects[0].srtloarder_settings
+        if not SrtLoaderWatchSrtFile.watching or not srtloarder_settings.srt_file:
+            context.window_manager.event_timer_remove(self._timer)
+            self._timer = None
+            SrtLoaderWatchSrtFile.watching = False
+            return {"FINISHED"}
+        if event.type != "TIMER":
+            return {"PASS_THROUGH"}
+
+        stat = self.get_srt_stat()
+        if stat is None or stat == self._last_stat:
+            return {"PASS_THROUGH"}
+        self._last_stat = stat
+
+        srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
+        if srtloarder_jimaku.jimaku_data_changed:
+            self.report(
+                type={"WARNING"},
+                message="未保存の変更があるため、字幕ファイルの変更を読み込みません",
+            )
+            return {"PASS_THROUGH"}
+
+        srt_path = bpy.path.abspath(srtloarder_settings.srt_file)
+        added, updated, removed, _ = reload_jimaku(srt_path, srtloarder_jimaku)
+        srtloarder_jimaku.jimaku_data_changed = False
+        if added or updated or removed:
+            self.report(
+                type={"INFO"},
+                message=f"字幕ファイルの変更を反映: 追加 {added}, 更新 {updated}, 削除 {removed}",
+            )
+            for area in context.screen.areas:
+                area.tag_redraw()
+        return {"PASS_THROUGH"}
+
+    def invoke(self, context: Context, event: Event) -> Set[str] | Set[int]:
+        if SrtLoaderWatchSrtFile.watching:
+            # 監視中の場合は停止する(実行中のmodalが終了する)
+            SrtLoaderWatchSrtFile.watching = False
+            return {"FINISHED"}
+
+        SrtLoaderWatchSrtFile.watching = True
+        self._last_stat = self.get_srt_stat()
+        self._timer = context.window_manager.event_timer_add(1.0, window=context.window)
+        context.window_manager.modal_handler_add(self)
+        return {"RUNNING_MODAL"}
+
+
 class SrtLoaderEditJimaku(bpy.types.Operator):
     bl_idname = "srt_loader.edit_jimaku"
     bl_label = "編集"
@@ -249,9 +660,10 @@ class SrtLoaderAddJimaku(bpy.types.Operator):
     def execute(self, context: Context) -> Set[str] | Set[int]:
         jimaku_list = bpy.data.objects[0].srtloarder_jimaku.list
         item = jimaku_list.add()
-        item.no = len(jimaku_list)
-        json_data = utils.get_default_style_json_data()
-        utils.update_styles(item.styles, json_data, False)
+        with props.dirty_tracker.editing(item):
+            item.no = len(jimaku_list)
+            json_data = utils.get_default_style_json_data()
+            utils.update_styles(item.styles, json_data, False)
         bpy.data.objects[0].srtloarder_jimaku.index = len(jimaku_list) - 1
         bpy.ops.srt_loader.update_jimaku_startframe()
         bpy.data.objects[0].srtloarder_jimaku.jimaku_data_changed = True
@@ -282,6 +694,145 @@ class SrtLoaderRemoveJimaku(bpy.types.Operator):
         return {"FINISHED"}
 
 
+class SrtLoaderLintTimeline(bpy.types.Operator):
+    bl_idname = "srt_loader.lint_timeline"
+    bl_label = "タイムラインの検査"
+    bl_description = "字幕の重なり、短すぎる間隔、1秒あたりの文字数の超過を検査する"
+    bl_options = {"REGISTER"}
+
+    min_gap_ms: bpy.props.IntProperty(
+        name="最小の間隔",
+        description="字幕間の最小の間隔 (単位: ms)。0の場合、検査しない",
+        default=my_timeline.DEFAULT_MIN_GAP_MS,
+        min=0,
+    )
+    max_cps: bpy.props.FloatProperty(
+        name="最大文字数/秒",
+        description="1秒あたりの最大文字数。0の場合、検査しない",
+        default=my_timeline.DEFAULT_MAX_CPS,
+        min=0,
+    )
+
+    @classmethod
+    def poll(cls, context):
+        jimaku_list = bpy.data.objects[0].srtloarder_jimaku.list
+        return len(jimaku_list) > 0
+
+    def execute(self, context: Context) -> Set[str] | Set[int]:
+        srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
+        jimaku_list = srtloarder_jimaku.list
+        violations = my_timeline.lint_timeline(
+            jimaku_to_spans(jimaku_list, utils.get_frame_rate()),
+            self.min_gap_ms,
+            self.max_cps,
+        )
+        if not violations:
+            self.report({"INFO"}, "タイムラインに問題はありません")
+            return {"FINISHED"}
+
+        numbers = [jimaku.no for jimaku in jimaku_list]
+        for v in violations:
+            print(my_timeline.describe_violation(v, numbers))
+        # 最初の違反箇所の字幕を選択する
+        srtloarder_jimaku.index = violations[0].index
+        self.report(
+            {"WARNING"},
+            f"{len(violations)}件の問題があります (詳細はコンソールを参照)",
+        )
+        return {"FINISHED"}
+
+    def invoke(self, context: Context, event: Event) -> Set[str] | Set[int]:
+        wm = context.window_manager
+        return wm.invoke_props_dialog(self)
+
+
+class SrtLoaderMeasureJimakuImages(bpy.types.Operator):
+    bl_idname = "srt_loader.measure_jimaku_images"
+    bl_label = "字幕画像の大きさの検査"
+    bl_description = (
+        "字幕画像を作成せずに大きさを計算し、画面からのはみ出しや縁取りの欠けを検査する"
+        " (Pillowでの作成時のレイアウトで計算する。Pillowが必要)"
+    )
+    bl_options = {"REGISTER"}
+
+    @classmethod
+    def poll(cls, context):
+        if not my_layout.is_available():
+            return False
+        jimaku_list = bpy.data.objects[0].srtloarder_jimaku.list
+        return len(jimaku_list) > 0
+
+    def execute(self, context: Context) -> Set[str] | Set[int]:
+        srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
+        srtloarder_settings = bpy.data.objects[0].srtloarder_settings
+        jimaku_list = srtloarder_jimaku.list
+        default_settings_path = os.path.join(
+            os.path.dirname(__file__), "default_settings.json"
+        )
+        try:
+            measurements = my_layout.measure(
+                utils.jimakulist_to_json(jimaku_list),
+                utils.settings_and_styles_to_json(
+                    srtloarder_settings, for_jimaku=False
+                ),
+                my_settings.read_config_file(default_settings_path),
+                utils.get_font_index_path(),
+            )
+        except (ValueError, RuntimeError) as e:
+            self.report({"ERROR"}, str(e))
+            return {"CANCELLED"}
+
+        render = context.scene.render
+        problems = []
+        for index, (jimaku, m) in enumerate(zip(jimaku_list, measurements)):
+            settings = srtloarder_settings.settings
+            if jimaku.settings.useJimakuSettings:
+                settings = jimaku.settings
+            overflow = my_layout.find_overflow(
+                m,
+                settings.offset_x,
+                settings.offset_y,
+                render.resolution_x,
+                render.resolution_y,
+            )
+            if overflow:
+                problems.append(
+                    (index, f"字幕{m.no}: 画面からはみ出します ({', '.join(overflow)})")
+                )
+            if m.clipped:
+                problems.append(
+                    (index, f"字幕{m.no}: 装飾が欠けます ({', '.join(m.clipped)})")
+                )
+        if not problems:
+            self.report(
+                {"INFO"}, "字幕画像の大きさに問題はありません (Pillowのレイアウトで計算)"
+            )
+            return {"FINISHED"}
+
+        for _, message in problems:
+            print(message)
+        # 最初の問題箇所の字幕を選択する
+        srtloarder_jimaku.index = problems[0][0]
+        self.report(
+            {"WARNING"},
+            f"{len(problems)}件の問題があります"
+            " (Pillowのレイアウトで計算。詳細はコンソールを参照)",
+        )
+        return {"FINISHED"}
+
+
+def jimaku_to_spans(jimaku_list, fps):
+    """
+    字幕情報のフレームを、タイムライン検査用のミリ秒の区間に変換する
+    """
+    spans = []
+    for jimaku in jimaku_list:
+        start_ms = round(jimaku.start_frame * 1000 / fps)
+        end_ms = round((jimaku.start_frame + jimaku.frame_duration) * 1000 / fps)
+        spans.append(my_timeline.Span(start_ms, end_ms, jimaku.text))
+    return spans
+
+
 class SrtLoaderUpdateJimakuStartFrame(bpy.types.Operator):
     bl_idname = "srt_loader.update_jimaku_startframe"
     bl_label = "字幕情報の開始フレームの更新"
@@ -556,7 +1107,7 @@ def create_image_strips(target_no=None, generated_by="srt_loader"):
 
 class SrtLoaderGenerateImagesBase:
     _timer = None
-    _proc = None
+    _shards = None
     _target_no = None
 
     @classmethod
@@ -571,33 +1122,43 @@ class SrtLoaderGenerateImagesBase:
             return len(jimaku_list) > 0
 
     def modal(self, context: Context, event: Event) -> Set[str] | Set[int]:
-        if event.type == "TIMER":
-            if ret := self._proc.poll() is None:
-                return {"RUNNING_MODAL"}
-            else:
-                if ret != 0:
-                    self.report(type={"ERROR"}, message="字幕画像 作成失敗")
-                    logging.error(f"stderr of gimp\n{self._proc.stderr.read()}")
-                else:
-                    self.report(type={"INFO"}, message="字幕画像 作成成功")
-                    logging.info(f"stdout of gimp\n{self._proc.stdout.read()}")
-                    create_image_strips(self._target_no)
-
-                context.window_manager.event_timer_remove(self._timer)
-                self.dispose()
-                return {"FINISHED"}
-        else:
+        if event.type != "TIMER":
             return {"RUNNING_MODAL"}
 
+        done = sum(shard.done for shard in self._shards)
+        total = sum(shard.total for shard in self._shards)
+        if any(shard.is_alive() for shard in self._shards):
+            context.workspace.status_text_set(f"字幕画像 作成中... {done}/{total}")
+            return {"RUNNING_MODAL"}
+
+        context.workspace.status_text_set(None)
+        errors = [shard.error for shard in self._shards if shard.error is not None]
+        for shard in self._shards:
+            if shard.output:
+                logging.info(f"stdout of gimp\n{shard.output}")
+        for error in errors:
+            logging.error(f"error of gimp\n{error}")
+        if errors:
+            self.report(
+                type={"ERROR"},
+                message=f"字幕画像 作成失敗 ({len(errors)}/{len(self._shards)}プロセス)",
+            )
+        else:
+            self.report(type={"INFO"}, message="字幕画像 作成成功")
+            create_image_strips(self._target_no)
+        context.window_manager.event_timer_remove(self._timer)
+        self.dispose()
+        return {"FINISHED"}
+
     def dispose(self):
-        self._proc.stdout.close()
-        self._proc.stderr.close()
         self._timer = None
-        self._proc = None
+        self._shards = None
+
+    def get_target_list(self, jimaku_data):
+        return jimaku_data.list
 
-    def create_script_for_stdin(self, jimaku_data, srtloarder_settings):
-        jimaku_list = jimaku_data.list
-        srt_json = utils.jimakulist_to_json(jimaku_list)
+    def create_job(self, jimaku_data, srtloarder_settings):
+        srt_json = utils.jimakulist_to_json(self.get_target_list(jimaku_data))
 
         default_json = utils.settings_and_styles_to_json(
             srtloarder_settings, for_jimaku=False
@@ -607,9 +1168,14 @@ class SrtLoaderGenerateImagesBase:
         )
         default_settings = my_settings.read_config_file(default_settings_path)
         output_dir = bpy.path.abspath(srtloarder_settings.image_dir)
-        return utils.create_gimp_script(
-            srt_json, default_json, output_dir, default_settings
-        )
+        return {
+            "subtitles": srt_json,
+            "config": default_json,
+            "output_path": output_dir,
+            "default_config": default_settings,
+            "cache_dir": utils.get_render_cache_dir(),
+            "font_index_path": utils.get_font_index_path(),
+        }
 
     def invoke(self, context: Context, event: Event) -> Set[str] | Set[int]:
         addon_name = __name__.split(".")[0]
@@ -619,31 +1185,55 @@ class SrtLoaderGenerateImagesBase:
         jimaku_data = bpy.data.objects[0].srtloarder_jimaku
         srtloarder_settings = bpy.data.objects[0].srtloarder_settings
 
-        script = self.create_script_for_stdin(jimaku_data, srtloarder_settings)
+        if (
+            addon_prefs.render_backend == "PILLOW"
+            and not pil_renderer.is_available()
+        ):
+            self.report(
+                type={"ERROR"}, message="PillowまたはNumPyがインストールされていません"
+            )
+            return {"CANCELLED"}
 
-        cmdline = utils.create_gimp_command_line(gimp_path)
+        job = self.create_job(jimaku_data, srtloarder_settings)
+        # 字幕を分割し、複数のGIMP(Pillowの場合はスレッド)で並列に作成する
+        num_of_processes = max(1, addon_prefs.render_processes)
+        shard_jobs = render_shard.split_render_job(job, num_of_processes)
+        if addon_prefs.render_backend == "PILLOW":
+            self._shards = [
+                render_shard.PillowRenderShard(shard_job) for shard_job in shard_jobs
+            ]
+            interval = 0.1
+        elif addon_prefs.use_render_server:
+            self._shards = [
+                gimp_server.ServerRenderShard(
+                    gimp_path,
+                    shard_job,
+                    gimp_server.get_render_server(i),
+                    addon_prefs.render_server_idle_timeout,
+                )
+                for i, shard_job in enumerate(shard_jobs)
+            ]
+            interval = 0.1
+        else:
+            self._shards = [
+                gimp_server.ProcessRenderShard(gimp_path, shard_job)
+                for shard_job in shard_jobs
+            ]
+            interval = 1.0
+        for shard in self._shards:
+            shard.start()
 
-        self._proc = subprocess.Popen(
-            cmdline,
-            shell=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
+        self.report(
+            type={"INFO"},
+            message=f"字幕画像 作成開始... ({len(self._shards)}プロセス)",
+        )
+        self._timer = context.window_manager.event_timer_add(
+            interval, window=context.window
         )
-        self.send_to_stdin(script)
-        logging.info(f"script: \n{script}")
-
-        self.report(type={"INFO"}, message="字幕画像 作成開始...")
-        self._timer = context.window_manager.event_timer_add(1.0, window=context.window)
         context.window_manager.modal_handler_add(self)
 
         return {"RUNNING_MODAL"}
 
-    def send_to_stdin(self, script):
-        self._proc.stdin.write(script)
-        self._proc.stdin.close()
-
 
 class SrtLoaderGenerateAllJimakuImages(SrtLoaderGenerateImagesBase, bpy.types.Operator):
     bl_idname = "srt_loader.generate_all_jimaku_images"
@@ -660,26 +1250,10 @@ class SrtLoaderGenerateCurrentJimakuImage(
     bl_description = "現在の字幕の画像を作成する"
     bl_options = {"REGISTER", "UNDO"}
 
-    def create_script_for_stdin(self, jimaku_data, srtloarder_settings):
-        jimaku_index = jimaku_data.index
-        jimaku = jimaku_data.list[jimaku_index]
-        jimaku_list = [jimaku]
-
+    def get_target_list(self, jimaku_data):
+        jimaku = jimaku_data.list[jimaku_data.index]
         self._target_no = jimaku.no
-
-        srt_json = utils.jimakulist_to_json(jimaku_list)
-
-        default_json = utils.settings_and_styles_to_json(
-            srtloarder_settings, for_jimaku=False
-        )
-        default_settings_path = os.path.join(
-            os.path.dirname(__file__), "default_settings.json"
-        )
-        default_settings = my_settings.read_config_file(default_settings_path)
-        output_dir = bpy.path.abspath(srtloarder_settings.image_dir)
-        return utils.create_gimp_script(
-            srt_json, default_json, output_dir, default_settings
-        )
+        return [jimaku]
 
 
 class SrtLoaderRepositionCurrentJimakuImage(bpy.types.Operator):
@@ -1073,12 +1647,16 @@ class_list = [
     StrLoaderGetTimestampOfPlayhead,
     SrtLoaderResetSrtFile,
     SrtLoaderReadSrtFile,
+    SrtLoaderWatchSrtFile,
     SrtLoaderSaveSrtFile,
+    SrtLoaderAutoSaveSrtFile,
     SrtLoaderEditJimaku,
     SrtLoaderSaveJimaku,
     SrtLoaderCancelJimaku,
     SrtLoaderAddJimaku,
     SrtLoaderRemoveJimaku,
+    SrtLoaderLintTimeline,
+    SrtLoaderMeasureJimakuImages,
     SrtLoaderUpdateJimakuStartFrame,
     SrtLoaderUpdateJimakuFrameDuration,
     SrtLoaderUpdateJimakuSettings,
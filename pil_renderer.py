@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+"""
+GIMPを使わずに、Pillow/NumPyで字幕画像を作成する
+
+subtitle_creatorと同じ設定(default_settings.json)・引数で字幕画像を作成する。
+GIMPの処理(テキストレイヤー、選択範囲の拡大による縁取り、ドロップシャドウ、
+ボックス、統合、切り抜き)を、レイヤーごとのアルファ値の配列で再現する。
+Blender内やGIMPがない環境で動作する。
+"""
+import functools
+import math
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+try:
+    import numpy
+    from PIL import Image, ImageColor, ImageDraw
+except ImportError:
+    numpy = None
+    Image = None
+
+try:
+    from . import font_index
+    from . import my_layout
+    from . import my_settings
+    from . import my_style
+    from . import render_cache
+except ImportError:
+    import font_index
+    import my_layout
+    import my_settings
+    import my_style
+    import render_cache
+
+# 描画方法のバージョン(字幕画像のキャッシュのキーに含める)。描画結果が変わる場合は更新する
+RENDERER_VERSION = "pillow:5"
+# GIMPの選択範囲のぼかし(gimp_selection_feather)の半径から、ガウスぼかしの標準偏差への変換率
+FEATHER_SIGMA_RATE = my_layout.FEATHER_SIGMA_RATE
+# ガウスぼかしを近似するボックスぼかしの回数
+NUM_OF_BOX_BLURS = 3
+# GlyphCacheが保持するグリフ画像の最大の合計サイズ(単位: バイト)
+DEFAULT_GLYPH_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def is_available():
+    return Image is not None
+
+
+def to_rgb(color):
+    """
+    :param str color: 色("#40516a"など)
+    :return 0〜1のRGBのnumpy配列
+    """
+    return numpy.array(ImageColor.getrgb(color)[:3], dtype=numpy.float32) / 255
+
+
+to_px = my_layout.to_px
+
+
+def distance_field(mask, max_distance):
+    """
+    アルファ値が0.5以上のピクセルまでのユークリッド距離を計算する
+
+    縦方向の距離を求めてから横方向に合成する(分離可能な距離変換)。
+    max_distanceまでの距離だけを求めるため、計算量はO(画素数 * max_distance)。
+
+    :param mask: アルファ値の配列
+    :param int max_distance: 計算する最大の距離
+    :return 距離の配列。max_distanceより遠いピクセルはmax_distance + 1
+    """
+    inside = mask >= 0.5
+    far = numpy.float32(max_distance + 1)
+    # 縦方向の距離の2乗
+    dist_y = numpy.where(inside, numpy.float32(0), far)
+    for dy in range(1, max_distance + 1):
+        d = numpy.float32(dy)
+        numpy.minimum(dist_y[dy:], numpy.where(inside[:-dy], d, far), out=dist_y[dy:])
+        numpy.minimum(
+            dist_y[:-dy], numpy.where(inside[dy:], d, far), out=dist_y[:-dy]
+        )
+    dist_y *= dist_y
+    # 横方向に合成した距離の2乗
+    dist = dist_y.copy()
+    for dx in range(1, max_distance + 1):
+        d2 = numpy.float32(dx * dx)
+        numpy.minimum(dist[:, dx:], dist_y[:, :-dx] + d2, out=dist[:, dx:])
+        numpy.minimum(dist[:, :-dx], dist_y[:, dx:] + d2, out=dist[:, :-dx])
+    numpy.sqrt(dist, out=dist)
+    return numpy.minimum(dist, far, out=dist)
+
+
+# 相補誤差関数の表 (ぼかした縁取りの輪郭に使う)
+ERFC_RANGE = 4.0
+ERFC_STEPS = 801
+_erfc_table = None
+
+
+def erfc(values):
+    global _erfc_table
+    if _erfc_table is None:
+        xs = numpy.linspace(-ERFC_RANGE, ERFC_RANGE, ERFC_STEPS, dtype=numpy.float32)
+        _erfc_table = (xs, numpy.array([math.erfc(x) for x in xs], numpy.float32))
+    return numpy.interp(values, *_erfc_table).astype(numpy.float32)
+
+
+def get_border_radii(borders):
+    """
+    縁取りごとの、テキストからの半径とぼかしの標準偏差を返す
+
+    GIMPと同じく、縁取りは前の縁取りを拡大したものなので、半径は拡大幅(整数)の累計になる
+
+    :return [(縁取りのスタイル, 半径, 標準偏差)]
+    """
+    radii = []
+    radius = 0
+    for border in borders:
+        if not border:
+            continue
+        radius += int(border.grow)
+        radii.append((border, radius, border.feather * FEATHER_SIGMA_RATE))
+    return radii
+
+
+def make_border_masks(text_mask, borders):
+    """
+    縁取りのアルファ値を作成する
+
+    テキストからの距離場を1回だけ計算し、全ての縁取りをその距離場から求める。
+    そのため、縁取りの数が増えても、ほとんど遅くならない。
+    ぼかした縁取りは、直線の輪郭をガウスぼかしした場合の輪郭(相補誤差関数)で近似する。
+
+    :param text_mask: テキストのアルファ値
+    :param borders: 縁取りのスタイル(my_style.BorderStyle)の配列。Noneは無視する
+    :return [(縁取りのスタイル, アルファ値)]。内側の縁取りから順に並ぶ
+    """
+    radii = get_border_radii(borders)
+    if not radii:
+        return []
+    max_distance = max(r + int(math.ceil(3 * sigma)) for _, r, sigma in radii) + 1
+    dist = distance_field(text_mask, max_distance)
+    masks = []
+    mask = text_mask
+    for border, radius, sigma in radii:
+        if sigma > 0:
+            ring = erfc((dist - radius) / numpy.float32(sigma * math.sqrt(2))) * 0.5
+        else:
+            ring = numpy.clip(radius + 0.5 - dist, 0, 1)
+        # 内側の縁取り(最初はテキスト)を含める
+        mask = numpy.maximum(ring, mask)
+        masks.append((border, mask))
+    return masks
+
+
+@functools.lru_cache(maxsize=None)
+def get_box_sizes(radius):
+    """
+    ぼかしの半径に対応する、ボックスぼかしの幅(奇数)の一覧を返す
+
+    NUM_OF_BOX_BLURS回のボックスぼかしの分散の合計が、
+    ガウスぼかしの分散に最も近くなる幅を選ぶ。
+
+    :param radius: GIMPのぼかしの半径
+    :return ボックスぼかしの幅のタプル。ぼかさない場合は空
+    """
+    sigma = radius * FEATHER_SIGMA_RATE
+    n = NUM_OF_BOX_BLURS
+    ideal = math.sqrt(12 * sigma * sigma / n + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    if lower < 1:
+        return ()
+    upper = lower + 2
+    # lowerの幅を使う回数
+    variance = 12 * sigma * sigma
+    m = round((variance - n * lower * lower - 4 * n * lower - 3 * n) / (-4 * lower - 4))
+    sizes = tuple(lower if i < m else upper for i in range(n))
+    return tuple(size for size in sizes if size > 1)
+
+
+def box_blur(values, size, axis):
+    """
+    1方向のボックスぼかし。累積和を使うため、幅によらずO(画素数)
+
+    配列の外側は0とみなし、結果は(size - 1)だけ大きくなる
+    """
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (size, size - 1)
+    summed = numpy.cumsum(numpy.pad(values, pad), axis=axis, dtype=numpy.float64)
+    if axis == 0:
+        result = summed[size:] - summed[:-size]
+    else:
+        result = summed[:, size:] - summed[:, :-size]
+    return (result / size).astype(numpy.float32)
+
+
+def make_shadow_mask(mask, shadow):
+    """
+    影のアルファ値を作成する (script_fu_drop_shadowに相当)
+
+    アルファ値がある範囲だけを切り出し、縦横に分けたボックスぼかしを繰り返して
+    ガウスぼかしを近似する。ずらした結果は元の画像の範囲で切り取る。
+
+    :param mask: 影を付けるアルファ値(一番下のレイヤー)
+    :param my_style.ShadowStyle shadow: 影のスタイル
+    :return 影のアルファ値(maskと同じ大きさ)。影がない場合はNone
+    """
+    bounds = get_bounds(mask)
+    if bounds is None or shadow.opacity <= 0:
+        return None
+    w, h, x, y = bounds
+    blurred = mask[y : y + h, x : x + w]
+    for size in get_box_sizes(shadow.blur_radius):
+        blurred = box_blur(blurred, size, 0)
+        blurred = box_blur(blurred, size, 1)
+    # ぼかしで広がった分と影の位置だけずらす
+    margin = (blurred.shape[1] - w) // 2, (blurred.shape[0] - h) // 2
+    x += to_px(shadow.offset_x) - margin[0]
+    y += to_px(shadow.offset_y) - margin[1]
+    result = numpy.zeros_like(mask)
+    canvas_h, canvas_w = mask.shape
+    x1, y1 = max(0, x), max(0, y)
+    x2 = min(canvas_w, x + blurred.shape[1])
+    y2 = min(canvas_h, y + blurred.shape[0])
+    if x1 < x2 and y1 < y2:
+        result[y1:y2, x1:x2] = blurred[y1 - y : y2 - y, x1 - x : x2 - x]
+    result *= shadow.opacity
+    return result
+
+
+def to_px_array(mask):
+    return numpy.clip(mask * 255 + 0.5, 0, 255).astype(numpy.uint8)
+
+
+def get_bounds(mask):
+    """
+    アルファ値が0より大きい範囲を返す (get_text_areaに相当)
+
+    :return (幅, 高さ, x, y)。範囲がない場合はNone
+    """
+    ys = numpy.flatnonzero(mask.any(axis=1))
+    xs = numpy.flatnonzero(mask.any(axis=0))
+    if len(ys) == 0:
+        return None
+    return (xs[-1] + 1 - xs[0], ys[-1] + 1 - ys[0], xs[0], ys[0])
+
+
+# グリフの画像と位置
+#   bitmap: アルファ値(uint8)の配列
+#   offset_x, offset_y, width, height, advance: my_layout.GlyphBoxと同じ
+Glyph = namedtuple(
+    "Glyph", ["bitmap", "offset_x", "offset_y", "width", "height", "advance"]
+)
+
+
+class GlyphCache(my_layout.MetricsCache):
+    """
+    フォント・サイズごとに、ラスタライズしたグリフをキャッシュする
+
+    グリフ画像の合計サイズがmax_bytesを超えた場合、最も古く使われたものから削除する。
+    FreeTypeFontはスレッド間で共有できないため、1つのスレッドで使うこと
+    (acquire_glyph_cache, release_glyph_cacheを参照)。
+    """
+
+    def __init__(self, fonts, max_bytes=DEFAULT_GLYPH_CACHE_SIZE):
+        """
+        :param font_index.FontIndex fonts: フォント名からフォントファイルを探すインデックス
+        """
+        super().__init__(fonts)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._glyphs = OrderedDict()
+
+    def get_glyph(self, font_family, font_size, char):
+        key = (font_family, font_size, char)
+        glyph = self._glyphs.pop(key, None)
+        if glyph is None:
+            glyph = self.rasterize(self.get_font(font_family, font_size), char)
+            self.size += glyph.bitmap.nbytes
+            while self._glyphs and self.size > self.max_bytes:
+                _, old = self._glyphs.popitem(last=False)
+                self.size -= old.bitmap.nbytes
+        self._glyphs[key] = glyph
+        return glyph
+
+    @staticmethod
+    def rasterize(font, char):
+        left, top, right, bottom = font.getbbox(char, anchor="ls")
+        advance = font.getlength(char)
+        if right <= left or bottom <= top:
+            return Glyph(numpy.zeros((0, 0), dtype=numpy.uint8), 0, 0, 0, 0, advance)
+        w, h = right - left, bottom - top
+        image = Image.new("L", (w, h), 0)
+        draw = ImageDraw.Draw(image)
+        draw.text((-left, -top), char, fill=255, font=font, anchor="ls")
+        return Glyph(numpy.asarray(image), left, top, w, h, advance)
+
+
+# スレッドから使われていないGlyphCache
+_glyph_caches = []
+_glyph_caches_lock = threading.Lock()
+
+
+def acquire_glyph_cache(fonts):
+    """
+    使われていないGlyphCacheを取り出す (ない場合は作成する)
+
+    作成のたびに別スレッドで実行されても、以前にラスタライズしたグリフを使えるようにする。
+    フォントのインデックスが作り直された場合は、キャッシュを作り直す。
+    """
+    with _glyph_caches_lock:
+        while _glyph_caches:
+            glyphs = _glyph_caches.pop()
+            if glyphs.fonts is fonts and glyphs.generation == fonts.generation:
+                return glyphs
+    return GlyphCache(fonts)
+
+
+def release_glyph_cache(glyphs):
+    with _glyph_caches_lock:
+        _glyph_caches.append(glyphs)
+
+
+def compose_text(placed, w, h, offset_x, offset_y):
+    """
+    グリフを並べて、テキストのアルファ値を作成する
+
+    :param placed: my_layout.layout_textで計算した、グリフとその位置
+    :return アルファ値(0〜1)の配列
+    """
+    text_mask = numpy.zeros((h, w), dtype=numpy.uint8)
+    for glyph, x, y in placed:
+        bitmap = glyph.bitmap
+        if not bitmap.size:
+            continue
+        gx = to_px(offset_x + x) + glyph.offset_x
+        gy = to_px(offset_y + y) + glyph.offset_y
+        x1, y1 = max(0, gx), max(0, gy)
+        x2 = min(w, gx + bitmap.shape[1])
+        y2 = min(h, gy + bitmap.shape[0])
+        if x1 >= x2 or y1 >= y2:
+            continue
+        region = text_mask[y1:y2, x1:x2]
+        numpy.maximum(
+            region, bitmap[y1 - gy : y2 - gy, x1 - gx : x2 - gx], out=region
+        )
+    return text_mask.astype(numpy.float32) / 255
+
+
+def render_subtitle(text, style, glyphs, output_path, debug=False):
+    """
+    字幕画像を1つ作成する
+
+    :param str text: 字幕のテキスト
+    :param my_style.CompiledStyle style: スタイル
+    :param GlyphCache glyphs: グリフのキャッシュ
+    :param str output_path: 出力先のパス
+    :param bool debug: Trueの場合、切り抜かずに出力する
+    """
+    text_w, text_h, placed, _ = my_layout.layout_text(text, glyphs, style)
+    offset_x = to_px(style.canvas_padding_x)
+    offset_y = to_px(style.canvas_padding_y)
+    w = text_w + offset_x * 2
+    h = text_h + offset_y * 2
+
+    # テキスト
+    text_mask = compose_text(placed, w, h, offset_x, offset_y)
+    # (色, アルファ値)のレイヤー。上にあるレイヤーから順に並べる
+    layers = [(to_rgb(style.text_color), text_mask)]
+
+    # 縁取り
+    mask = text_mask
+    for border, mask in make_border_masks(text_mask, style.borders):
+        layers.append((to_rgb(border.color), mask))
+
+    # 影。一番下のレイヤーをぼかして、ずらす
+    shadow = style.shadow
+    shadow_mask = make_shadow_mask(mask, shadow) if shadow else None
+    if shadow_mask is not None:
+        layers.append((to_rgb(shadow.color), shadow_mask))
+
+    # テキストの範囲はグリフの外接矩形から求める (my_layout.measure_subtitleと同じ)
+    text_area = my_layout.get_text_bounds(placed, offset_x, offset_y)
+    if text_area is None:
+        print("選択領域がない!!")
+        text_area = (0, 0, offset_x, offset_y)
+
+    box = style.box
+    if box:
+        box_mask = numpy.zeros((h, w), dtype=numpy.float32)
+        pdx = to_px(box.padding_x)
+        pdy = to_px(box.padding_y)
+        x1 = max(0, text_area[2] - pdx)
+        y1 = max(0, text_area[3] - pdy)
+        x2 = text_area[2] + text_area[0] + pdx
+        y2 = text_area[3] + text_area[1] + pdy
+        box_mask[y1:y2, x1:x2] = box.opacity / 100.0
+        layers.append((to_rgb(box.color), box_mask))
+
+    # 可視レイヤーを1つに統合 (下のレイヤーから順に重ねる)
+    rgb = numpy.zeros((h, w, 3), dtype=numpy.float32)
+    alpha = numpy.zeros((h, w), dtype=numpy.float32)
+    for color, layer_alpha in reversed(layers):
+        rgb *= (1 - layer_alpha)[:, :, None]
+        rgb += layer_alpha[:, :, None] * color
+        alpha *= 1 - layer_alpha
+        alpha += layer_alpha
+    rgb /= numpy.maximum(alpha, 1e-6)[:, :, None]
+    pixels = numpy.dstack([rgb, alpha[:, :, None]])
+    image = Image.fromarray(to_px_array(pixels), "RGBA")
+
+    if not debug:
+        # crop (画像の外側は透明になる)
+        pdx = to_px(style.crop_padding_x)
+        pdy = to_px(style.crop_padding_y)
+        ofx = text_area[2] - pdx
+        ofy = text_area[3] - pdy
+        image = image.crop(
+            (ofx, ofy, ofx + text_area[0] + pdx * 2, ofy + text_area[1] + pdy * 2)
+        )
+    image.save(output_path)
+
+
+def generate_subtitles(
+    subtitles,
+    settings,
+    output_dir,
+    debug=False,
+    cache_dir=None,
+    progress=None,
+    fonts=None,
+):
+    """
+    字幕画像を作成する (subtitle_creator.generate_subtitlesと同じ)
+
+    :param progress: 字幕画像を1つ作成するごとに、字幕番号を渡して呼び出す関数
+    :param font_index.FontIndex fonts: フォントのインデックス。Noneの場合はデフォルト
+    """
+    if fonts is None:
+        fonts = font_index.get_font_index()
+    merger = my_settings.SettingsMerger(settings)
+    # GIMPと異なり、縁取りの数は制限しない
+    compiler = my_style.StyleCompiler(None, my_layout.resolve_justify)
+    cache = None
+    if cache_dir and not debug:
+        cache = render_cache.RenderCache(cache_dir)
+    glyphs = acquire_glyph_cache(fonts)
+    try:
+        for st in subtitles:
+            text = "\n".join(st["lines"])
+            style = compiler.compile(merger.merge(st["time_info"].get("json")))
+            output_path = os.path.join(output_dir, "{}.png".format(st["no"]))
+            if cache is None:
+                render_subtitle(text, style, glyphs, output_path, debug)
+            else:
+                key = cache.make_key(RENDERER_VERSION, text, style)
+                if not cache.materialize(key, output_path):
+                    # キャッシュと共有している画像を上書きしないように、先に削除する
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                    render_subtitle(text, style, glyphs, output_path, debug)
+                    cache.store(key, output_path)
+            if progress is not None:
+                progress(st["no"])
+    finally:
+        release_glyph_cache(glyphs)
+    if cache is not None:
+        cache.evict()
+
+
+def expand_abspath(path):
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def render(
+    subtitles,
+    config,
+    output_path,
+    default_config,
+    debug=False,
+    cache_dir=None,
+    progress=None,
+    font_index_path=None,
+):
+    """
+    字幕画像を作成する (subtitle_creator.renderと同じ)
+
+    :param str font_index_path: フォントのインデックスの保存先。Noneの場合はデフォルト
+    """
+    if not is_available():
+        raise RuntimeError("PillowまたはNumPyがインストールされていません")
+    merged_config = my_settings.merge_settings(default_config, config)
+    abs_outpath = expand_abspath(output_path)
+    if not os.path.exists(abs_outpath):
+        os.makedirs(abs_outpath)
+    fonts = font_index.get_font_index(font_index_path or font_index.DEFAULT_INDEX_PATH)
+    generate_subtitles(
+        subtitles, merged_config, abs_outpath, debug, cache_dir, progress, fonts
+    )
+
+
+def run(subtitles, config, output_path, default_config, debug=False, cache_dir=None):
+    render(subtitles, config, output_path, default_config, debug, cache_dir)
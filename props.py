@@ -1,9 +1,92 @@
 import bpy
+import contextlib
+import itertools
 from . import utils
 
 
+class JimakuDirtyTracker:
+    """
+    字幕情報の変更を、字幕情報ごとの変更番号(revision)で追跡する
+
+    変更番号はセッション内で一意な番号で、変更のたびに新しい番号にする。
+    保存時は変更番号が前回保存時と同じ字幕情報の字幕ブロックを使い回す。
+    blendファイルを開いた時に、全ての字幕情報の変更番号を0(未保存)に戻す。
+    """
+
+    def __init__(self):
+        self._revisions = itertools.count(1)
+        # プロパティーを更新中の字幕情報(ネストした設定・スタイルの変更の所有者)
+        self._editing = None
+        # 変更された字幕情報を特定できなかった場合はTrue
+        self.all_dirty = False
+
+    def mark(self, jimaku):
+        jimaku.revision = next(self._revisions)
+        return jimaku.revision
+
+    @contextlib.contextmanager
+    def editing(self, jimaku):
+        """
+        字幕情報の設定・スタイルを、選択中でない字幕情報についてまとめて更新する場合に使う
+        """
+        self._editing = jimaku
+        try:
+            yield jimaku
+        finally:
+            self._editing = None
+        self.mark(jimaku)
+
+    def find_owner(self, jimaku_data, group):
+        """
+        ネストした設定・スタイル(group)を持つ字幕情報を返す。見つからない場合はNone
+
+        path_from_idは全てのプロパティーを探索して遅いため、更新中の字幕情報と、
+        パネルで編集できる選択中の字幕情報だけを調べる
+        """
+        if self._editing is not None:
+            return self._editing
+        index = jimaku_data.index
+        if not 0 <= index < len(jimaku_data.list):
+            return None
+        jimaku = jimaku_data.list[index]
+        styles = jimaku.styles
+        groups = (
+            jimaku.settings,
+            styles,
+            styles.image,
+            styles.text,
+            styles.borders,
+            styles.borders.style1,
+            styles.borders.style2,
+            styles.shadow,
+            styles.box,
+        )
+        pointer = group.as_pointer()
+        if any(g.as_pointer() == pointer for g in groups):
+            return jimaku
+        return None
+
+    def reset(self, jimaku_data):
+        for jimaku in jimaku_data.list:
+            jimaku.revision = 0
+        self.all_dirty = False
+
+
+dirty_tracker = JimakuDirtyTracker()
+
+
 def update_jimaku_property(self, context):
-    bpy.data.objects[0].srtloarder_jimaku.jimaku_data_changed = True
+    srtloarder_jimaku = bpy.data.objects[0].srtloarder_jimaku
+    srtloarder_jimaku.jimaku_data_changed = True
+    if isinstance(self, SrtLoaderJimakuProperties):
+        jimaku = self
+    else:
+        jimaku = dirty_tracker.find_owner(srtloarder_jimaku, self)
+    if jimaku is not None:
+        dirty_tracker.mark(jimaku)
+    else:
+        # 次回の保存で全ての字幕ブロックを作り直す
+        dirty_tracker.all_dirty = True
 
 
 class SrtLoaderImageStyleProperties(bpy.types.PropertyGroup):
@@ -198,6 +281,10 @@ class SrtLoaderJimakuProperties(bpy.types.PropertyGroup):
     )
     settings: bpy.props.PointerProperty(type=SrtLoaderJimakuSettingsPorperties)
     styles: bpy.props.PointerProperty(type=SrtLoaderJimakuStylePorperties)
+    # 読み込み元の字幕ブロックのハッシュ値(差分読み込み用)
+    source_hash: bpy.props.StringProperty(default="")
+    # 変更番号(JimakuDirtyTrackerを参照)。0の場合は未保存
+    revision: bpy.props.IntProperty(default=0)
 
 
 class SrtLoaderCurrentJimakuProperties(bpy.types.PropertyGroup):
@@ -205,6 +292,8 @@ class SrtLoaderCurrentJimakuProperties(bpy.types.PropertyGroup):
     list: bpy.props.CollectionProperty(type=SrtLoaderJimakuProperties)
     jimaku_editing: bpy.props.BoolProperty(default=False)
     jimaku_data_changed: bpy.props.BoolProperty(default=False)
+    # 字幕ファイルを読み込んだ時のフレームレート(差分読み込み用)
+    source_fps: bpy.props.FloatProperty(default=0)
 
 
 class_list = [
@@ -132,6 +132,18 @@ class SrtLoaderProperties(bpy.types.PropertyGroup):
     settings: bpy.props.PointerProperty(type=SrtLoaderDefaultSettingsProperties)
     styles: bpy.props.PointerProperty(type=SrtLoaderDefaultStylesProperties)
     initialized: bpy.props.BoolProperty(default=False)
+    use_style_table: bpy.props.BoolProperty(
+        name="スタイル表を使う",
+        description="字幕個別のスタイルをスタイル表(.styles.json)に1つずつ保存し、"
+        "字幕ファイルにはスタイルIDだけを書き込む",
+        default=False,
+    )
+    autosave_interval: bpy.props.IntProperty(
+        name="自動保存の間隔",
+        description="字幕ファイルを自動保存する間隔 (単位: 秒)",
+        default=30,
+        min=5,
+    )
 
 
 class_list = [
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+try:
+    from . import my_files
+except (ImportError, ValueError):
+    # GIMP(Python 2)用
+    import my_files
+
+DEFAULT_RENDER_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+class RenderCache(object):
+    """
+    作成した字幕画像を、テキスト・スタイル・描画方法のハッシュ値をキーとして保存するキャッシュ
+
+    同じキーの画像はハードリンク(できない場合はコピー)で出力先に配置する。
+    エントリーは一時ファイルからのリネームで追加するため、複数のプロセスで共有できる。
+    キャッシュの合計サイズがmax_bytesを超えた場合、最も古く使われたものから削除する。
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_RENDER_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(renderer, text, style):
+        """
+        :param str renderer: 描画方法とそのバージョン
+        :param text: 字幕のテキスト
+        :param style: 描画に使う全てのスタイル(my_style.CompiledStyleなど、reprが内容を表すもの)
+        :return str キャッシュのキー
+        """
+        h = hashlib.sha256()
+        for part in (renderer, text, repr(style)):
+            # GIMPのスクリプト経由ではstr、サーバー経由ではunicodeになる
+            if not isinstance(part, bytes):
+                part = part.encode("utf-8")
+            h.update(part)
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".png")
+
+    def materialize(self, key, dest_path):
+        """
+        キャッシュの画像を出力先に配置する
+
+        :return キャッシュにあった場合はTrue
+        """
+        path = self.get_path(key)
+        try:
+            # 使われた時刻としてキャッシュの更新時刻を更新する
+            os.utime(path, None)
+        except OSError:
+            return False
+        try:
+            _link_or_copy(path, dest_path)
+        except (IOError, OSError) as e:
+            # 他のプロセスに削除された場合
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def store(self, key, src_path):
+        """
+        作成した画像をキャッシュに追加する
+
+        出力先の画像はキャッシュとハードリンクを共有するため、
+        出力先を作り直す場合は、先に出力先を削除すること。
+        """
+        path = self.get_path(key)
+        dir_path = os.path.dirname(path)
+        if not os.path.isdir(dir_path):
+            try:
+                os.makedirs(dir_path)
+            except OSError:
+                if not os.path.isdir(dir_path):
+                    raise
+        _link_or_copy(src_path, path)
+
+    def evict(self):
+        my_files.evict_old_files(self.cache_dir, ".png", self.max_bytes)
+
+
+def _link_or_copy(src_path, dest_path):
+    """
+    src_pathをdest_pathにハードリンク(できない場合はコピー)で置き換える
+
+    一時ファイルを作ってからリネームするため、dest_pathが中途半端な状態になることはない
+    """
+    dir_path = os.path.dirname(dest_path) or None
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=dir_path)
+    os.close(fd)
+    os.remove(tmp_path)
+    try:
+        try:
+            os.link(src_path, tmp_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise
+            shutil.copyfile(src_path, tmp_path)
+        my_files.replace_file(tmp_path, dest_path)
+        # 既に同じファイルへのハードリンクだった場合、リネームは何もしない
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
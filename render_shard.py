@@ -0,0 +1,66 @@
+import threading
+
+from . import pil_renderer
+
+
+def split_render_job(job, num_of_shards):
+    """
+    字幕画像の作成依頼を、字幕を分割して複数の依頼にする
+
+    字幕の長さが偏らないように、字幕を順番に振り分ける
+    """
+    subtitles = job["subtitles"]
+    num_of_shards = max(1, min(num_of_shards, len(subtitles)))
+    return [
+        dict(job, subtitles=subtitles[i::num_of_shards]) for i in range(num_of_shards)
+    ]
+
+
+class RenderShard:
+    """
+    分割した字幕画像の作成依頼を、別スレッドで実行する
+
+    サブクラスのrunで作成し、字幕を1つ作成するたびにdoneを増やす。
+    total, doneで進捗を、errorで失敗した場合のエラーを参照できる
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.total = len(job["subtitles"])
+        self.done = 0
+        self.error = None
+        self.output = ""
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.error = e
+
+
+class PillowRenderShard(RenderShard):
+    """
+    GIMPを使わずに、pil_rendererで作成する
+    """
+
+    def run(self):
+        pil_renderer.render(
+            self.job["subtitles"],
+            self.job["config"],
+            self.job["output_path"],
+            self.job["default_config"],
+            cache_dir=self.job.get("cache_dir"),
+            progress=self.on_progress,
+            font_index_path=self.job.get("font_index_path"),
+        )
+
+    def on_progress(self, no):
+        self.done += 1
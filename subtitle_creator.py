@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
+import my_files
 import my_settings
 import my_srt
+import my_style
+import render_cache
 import gimpfu
 import os
 import json
+import socket
+import sys
+import traceback
 from StringIO import StringIO
 
 MAX_NUM_OF_BORDERS = 2
+# 字幕画像を1つ作成するごとに標準出力に出力する行の接頭辞
+PROGRESS_PREFIX = "progress:"
+# 描画方法のバージョン(字幕画像のキャッシュのキーに含める)。描画結果が変わる場合は更新する
+RENDERER_VERSION = "gimp:2"
 
 pdb = gimpfu.pdb
 
@@ -26,9 +36,13 @@ def to_str(utf_str):
     return utf_str.encode("ascii", "ignore")
 
 
-def add_text(
-    target_layer, text, hexColor, font_name, font_size, justify, line_space_rate
-):
+def to_utf8(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+def add_text(target_layer, text, hexColor, font_name, font_size, justify, line_spacing):
     image = pdb.gimp_item_get_image(target_layer)
     text_layer = pdb.gimp_text_fontname(
         image,
@@ -45,11 +59,11 @@ def add_text(
     # 文字色を設定
     pdb.gimp_text_layer_set_color(text_layer, hexColor)
     # テキストをセンタリング
-    pdb.gimp_text_layer_set_justification(text_layer, get_justyfy(justify))
+    pdb.gimp_text_layer_set_justification(text_layer, justify)
     # offsetを初期化
     pdb.gimp_layer_set_offsets(text_layer, 0, 0)
     # 行間を調整
-    pdb.gimp_text_layer_set_line_spacing(text_layer, font_size * line_space_rate)
+    pdb.gimp_text_layer_set_line_spacing(text_layer, line_spacing)
     return text_layer
 
 
@@ -79,7 +93,7 @@ def add_layer(image, name, color=None, opacity=100, idx=0):
     return layer
 
 
-def add_outline(image, target_layer, i, font_size, border_setting):
+def add_outline(image, target_layer, i, border):
     outline_layer = pdb.gimp_layer_copy(target_layer, True)
     outline_layer.name = "アウトライン:{}".format(i)
     # ターゲットの下にレイヤーを配置
@@ -87,14 +101,14 @@ def add_outline(image, target_layer, i, font_size, border_setting):
     # レイヤー内の画像のアウトラインを選択
     pdb.gimp_image_select_item(image, gimpfu.CHANNEL_OP_ADD, outline_layer)
     # 選択範囲を拡大
-    pdb.gimp_selection_grow(image, font_size * border_setting["rate"])
-    if border_setting["feather"] > 0:
+    pdb.gimp_selection_grow(image, border.grow)
+    if border.feather > 0:
         # 選択範囲の境界をぼかす
-        pdb.gimp_selection_feather(image, font_size * border_setting["feather"])
+        pdb.gimp_selection_feather(image, border.feather)
 
     # 背景色を白に
     org_bg = pdb.gimp_context_get_background()
-    pdb.gimp_context_set_background(to_str(border_setting["color"]))
+    pdb.gimp_context_set_background(border.color)
     pdb.gimp_drawable_edit_fill(outline_layer, gimpfu.FILL_BACKGROUND)
     # 選択を解除
     pdb.gimp_selection_none(image)
@@ -115,131 +129,140 @@ def get_text_area(image, layer):
         return (x2 - x1, y2 - y1, x1, y1)
 
 
-def generate_subtitles(subtitles, settings, output_dir, debug=False):
+def generate_subtitles(subtitles, settings, output_dir, debug=False, cache_dir=None):
+    # 同じ字幕個別の設定のマージ結果とスタイルは使い回す
+    merger = my_settings.SettingsMerger(settings)
+    compiler = my_style.StyleCompiler(MAX_NUM_OF_BORDERS, get_justyfy, to_str)
+    cache = None
+    if cache_dir and not debug:
+        cache = render_cache.RenderCache(cache_dir)
     for st in subtitles:
-        print("{}:{}".format(st["no"], "\n".join(st["lines"])))
-        # 字幕個別の設定あり
-        st_settings = settings
-        if st["time_info"].get("json"):
-            st_settings = my_settings.merge_settings(settings, st["time_info"]["json"])
-        # imageの生成
-        image = pdb.gimp_image_new(10, 10, gimpfu.RGB)
-        tmp_layer = add_layer(image, "字幕")
-        text_setting = st_settings["styles"]["text"]
-        font_size = text_setting["size"]
-        # 字幕作成
-        text_layer = add_text(
-            tmp_layer,
-            "\n".join(st["lines"]),
-            to_str(text_setting["color"]),
-            to_str(text_setting["font_family"]),
-            font_size,
-            to_str(text_setting["align"]),
-            text_setting["line_space_rate"],
+        # サーバー経由ではunicodeになるため、スクリプト経由と同じutf-8のstrに揃える
+        text = to_utf8("\n".join(st["lines"]))
+        print("{}:{}".format(st["no"], text))
+        style = compiler.compile(merger.merge(st["time_info"].get("json")))
+        output_path = os.path.join(output_dir, "{}.png".format(st["no"]))
+        if cache is None:
+            render_subtitle(text, style, output_path, debug)
+        else:
+            key = cache.make_key(RENDERER_VERSION, text, style)
+            if not cache.materialize(key, output_path):
+                # キャッシュと共有している画像を上書きしないように、先に削除する
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                render_subtitle(text, style, output_path, debug)
+                cache.store(key, output_path)
+        # 進捗を通知する (呼び出し元が標準出力から読み取る)
+        print("{}{}".format(PROGRESS_PREFIX, st["no"]))
+        sys.stdout.flush()
+    if cache is not None:
+        cache.evict()
+
+
+def render_subtitle(text, style, output_path, debug=False):
+    # imageの生成
+    image = pdb.gimp_image_new(10, 10, gimpfu.RGB)
+    tmp_layer = add_layer(image, "字幕")
+    # 字幕作成
+    text_layer = add_text(
+        tmp_layer,
+        text,
+        style.text_color,
+        style.font_family,
+        style.font_size,
+        style.justify,
+        style.line_spacing,
+    )
+
+    offset_x = style.canvas_padding_x
+    offset_y = style.canvas_padding_y
+    text_w = pdb.gimp_drawable_width(text_layer)
+    text_h = pdb.gimp_drawable_height(text_layer)
+
+    w = text_w + offset_x * 2
+    h = text_h + offset_y * 2
+
+    # テキストをレイヤーに貼り付け
+    pdb.gimp_floating_sel_anchor(text_layer)
+    # レイヤーのサイズ修正
+    pdb.gimp_layer_resize(tmp_layer, w, h, offset_x, offset_y)
+    pdb.gimp_image_resize(image, w, h, offset_x, offset_y)
+
+    for i, border in enumerate(style.borders):
+        if not border:
+            print("{}に該当するボーダー設定がありません".format(i))
+            continue
+        target_layer = image.layers[i]
+        if not target_layer:
+            print("{}に該当するレイヤーがありません".format(i))
+            continue
+        add_outline(image, target_layer, i, border)
+
+    shadow = style.shadow
+    if shadow:
+        pdb.script_fu_drop_shadow(
+            image,
+            image.layers[-1],
+            shadow.offset_x,
+            shadow.offset_y,
+            shadow.blur_radius,
+            shadow.color,
+            shadow.opacity * 100,
+            False,
         )
 
-        canvas_setting = st_settings["canvas"]
-        offset_x = font_size * canvas_setting["padding_x_rate"]
-        offset_y = font_size * canvas_setting["padding_y_rate"]
-        text_w = pdb.gimp_drawable_width(text_layer)
-        text_h = pdb.gimp_drawable_height(text_layer)
-
-        w = text_w + offset_x * 2
-        h = text_h + offset_y * 2
-
-        # テキストをレイヤーに貼り付け
-        pdb.gimp_floating_sel_anchor(text_layer)
-        # レイヤーのサイズ修正
-        pdb.gimp_layer_resize(tmp_layer, w, h, offset_x, offset_y)
-        pdb.gimp_image_resize(image, w, h, offset_x, offset_y)
-
-        num_of_borders = min(MAX_NUM_OF_BORDERS, st_settings["number_of_borders"])
-        for i in range(num_of_borders):
-            border_setting = st_settings["styles"]["borders"][i]
-            if not border_setting:
-                print("{}に該当するボーダー設定がありません".format(i))
-                continue
-            target_layer = image.layers[i]
-            if not target_layer:
-                print("{}に該当するレイヤーがありません".format(i))
-                continue
-            add_outline(image, target_layer, i, font_size, border_setting)
-
-        if st_settings["with_shadow"]:
-            shadow_setting = st_settings["styles"]["shadow"]
-            if shadow_setting:
-                pdb.script_fu_drop_shadow(
-                    image,
-                    image.layers[-1],
-                    shadow_setting["offset_x"],
-                    shadow_setting["offset_y"],
-                    shadow_setting["blur_radius"],
-                    to_str(shadow_setting["color"]),
-                    shadow_setting["blur_radius"] * 100,
-                    False,
-                )
+    text_area = get_text_area(image, image.layers[0])
+
+    box = style.box
+    if box:
+        last_idx = len(image.layers)
+        box_layer = add_layer(image, "BOX", box.color, box.opacity, last_idx)
+        pdx = box.padding_x
+        pdy = box.padding_y
+        ofx = text_area[2] - pdx
+        ofy = text_area[3] - pdy
+        pdb.gimp_layer_resize(
+            box_layer,
+            text_area[0] + pdx * 2,
+            text_area[1] + pdy * 2,
+            ofx * -1,
+            ofy * -1,
+        )
 
-        text_area = get_text_area(image, image.layers[0])
-
-        if st_settings["with_box"]:
-            box_setting = st_settings["styles"]["box"]
-            if box_setting:
-                last_idx = len(image.layers)
-                box_layer = add_layer(
-                    image,
-                    "BOX",
-                    to_str(box_setting["color"]),
-                    box_setting["opacity"] * 100,
-                    last_idx,
-                )
-                pdx = box_setting["padding_x"]
-                pdy = box_setting["padding_y"]
-                ofx = text_area[2] - pdx
-                ofy = text_area[3] - pdy
-                pdb.gimp_layer_resize(
-                    box_layer,
-                    text_area[0] + pdx * 2,
-                    text_area[1] + pdy * 2,
-                    ofx * -1,
-                    ofy * -1,
-                )
+    if not debug:
+        # 可視レイヤーを1つに統合
+        merged_layer = pdb.gimp_image_merge_visible_layers(
+            image, gimpfu.CLIP_TO_IMAGE
+        )
+        merged_layer.name = "字幕 統合版"
+
+        # crop
+        pdx = style.crop_padding_x
+        pdy = style.crop_padding_y
+        ofx = text_area[2] - pdx
+        ofy = text_area[3] - pdy
+        pdb.gimp_layer_resize(
+            merged_layer,
+            text_area[0] + pdx * 2,
+            text_area[1] + pdy * 2,
+            ofx * -1,
+            ofy * -1,
+        )
+        pdb.gimp_image_resize(
+            image,
+            text_area[0] + pdx * 2,
+            text_area[1] + pdy * 2,
+            ofx * -1,
+            ofy * -1,
+        )
+        # 画像出力
+        pdb.gimp_file_save(image, merged_layer, output_path, output_path)
 
-        if not debug:
-            # 可視レイヤーを1つに統合
-            merged_layer = pdb.gimp_image_merge_visible_layers(
-                image, gimpfu.CLIP_TO_IMAGE
-            )
-            merged_layer.name = "字幕 統合版"
-
-            # crop
-            crop_setting = st_settings["crop_area"]
-            pdx = crop_setting["padding_x"]
-            pdy = crop_setting["padding_y"]
-            ofx = text_area[2] - pdx
-            ofy = text_area[3] - pdy
-            pdb.gimp_layer_resize(
-                merged_layer,
-                text_area[0] + pdx * 2,
-                text_area[1] + pdy * 2,
-                ofx * -1,
-                ofy * -1,
-            )
-            pdb.gimp_image_resize(
-                image,
-                text_area[0] + pdx * 2,
-                text_area[1] + pdy * 2,
-                ofx * -1,
-                ofy * -1,
-            )
-            # 画像出力
-            output_path = os.path.join(output_dir, "{}.png".format(st["no"]))
-            pdb.gimp_file_save(image, merged_layer, output_path, output_path)
-
-        if debug:
-            pdb.gimp_display_new(image)
-        else:
-            # imageの削除
-            pdb.gimp_image_delete(image)
+    if debug:
+        pdb.gimp_display_new(image)
+    else:
+        # imageの削除
+        pdb.gimp_image_delete(image)
 
 
 def expand_abspath(path):
@@ -254,7 +277,8 @@ def run_with_file(
     default_config = my_settings.read_config_file(default_config_path)
     abs_config_path = expand_abspath(config_path)
     config = my_settings.read_config_file(abs_config_path)
-    subtitles = my_srt.read_srt_file(expand_abspath(srt_path))
+    abs_srt_path = expand_abspath(srt_path)
+    subtitles = my_srt.iter_srt(abs_srt_path)
     run(subtitles, config, output_path, default_config, debug)
 
 
@@ -273,7 +297,18 @@ def run_with_json(
     run(subtitles, config, output_path, default_config, debug)
 
 
-def run(subtitles, config, output_path, default_config, debug=False):
+def run(
+    subtitles, config, output_path, default_config, debug=False, cache_dir=None
+):
+    render(subtitles, config, output_path, default_config, debug, cache_dir)
+    # gimp終了
+    if not debug:
+        pdb.gimp_quit(1)
+
+
+def render(
+    subtitles, config, output_path, default_config, debug=False, cache_dir=None
+):
     print("字幕画像作成開始...")
     # print("subtitles: {}".format(subtitles))
     # print("output_path: {}".format(output_path))
@@ -284,7 +319,86 @@ def run(subtitles, config, output_path, default_config, debug=False):
     abs_outpath = expand_abspath(output_path)
     if not os.path.exists(abs_outpath):
         os.makedirs(abs_outpath)
-    generate_subtitles(subtitles, merged_config, abs_outpath, debug)
-    # gimp終了
-    if not debug:
-        pdb.gimp_quit(1)
+    generate_subtitles(subtitles, merged_config, abs_outpath, debug, cache_dir)
+
+
+# 字幕画像作成サーバーが要求を待つ時間(単位: 秒)。この時間要求がない場合は終了する
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+def serve(port_path, token, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """
+    字幕画像の作成要求を受け付けるサーバーとして動作する
+
+    GIMPを終了せずに使い回すため、2回目以降はGIMPの起動やフォントの読み込みが不要になる。
+    localhostの空いているポートで待ち受け、ポート番号をport_pathにJSONで書き込む。
+    接続ごとに1行のJSONで要求を受け取り、1行のJSONで結果を返す。
+
+    :param str port_path: ポート番号を書き込むファイルのパス
+    :param str token: 要求に含まれている必要がある文字列
+    :param int idle_timeout: この時間(秒)要求がない場合はGIMPを終了する
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    server.settimeout(idle_timeout)
+    tmp_path = port_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"port": server.getsockname()[1], "pid": os.getpid()}, f)
+    my_files.replace_file(tmp_path, port_path)
+    print("字幕画像作成サーバー開始: {}".format(server.getsockname()))
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                print("字幕画像作成サーバー: 待ち時間を超えたため終了")
+                break
+            if not handle_request(conn, token):
+                break
+    finally:
+        server.close()
+        if os.path.exists(port_path):
+            os.remove(port_path)
+    pdb.gimp_quit(1)
+
+
+def handle_request(conn, token):
+    """
+    1件の要求を処理する
+
+    :return サーバーを続ける場合はTrue
+    """
+    conn.settimeout(None)
+    f = conn.makefile("rwb")
+    keep_running = True
+    try:
+        request = json.loads(f.readline().decode("utf-8"))
+        command = request.get("command")
+        result = {"status": "ok"}
+        if request.get("token") != token:
+            result = {"status": "error", "message": "invalid token"}
+        elif command == "render":
+            try:
+                render(
+                    request["subtitles"],
+                    request["config"],
+                    request["output_path"],
+                    request["default_config"],
+                    cache_dir=request.get("cache_dir"),
+                )
+            except Exception:
+                result = {"status": "error", "message": traceback.format_exc()}
+        elif command == "shutdown":
+            keep_running = False
+        elif command != "ping":
+            result = {"status": "error", "message": "unknown command"}
+        f.write(json.dumps(result).encode("utf-8") + b"\n")
+        f.flush()
+        return keep_running
+    except (IOError, ValueError) as e:
+        print("字幕画像作成サーバー: 不正な要求 {}".format(e))
+        return True
+    finally:
+        f.close()
+        conn.close()
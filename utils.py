@@ -7,6 +7,9 @@ import shutil
 import logging
 import re
 
+from . import my_files
+from . import my_srt
+
 
 def get_frame_rate():
     return bpy.context.scene.render.fps / bpy.context.scene.render.fps_base
@@ -190,23 +193,79 @@ def jimakulist_to_json(list):
     return results
 
 
-def jimakulist_to_srtdata(list):
-    results = []
-    for item in list:
-        results.append(f"{item.no}")
-        start_time = format_srt_timestamp(bpy.utils.time_from_frame(item.start_frame))
-        end_time = format_srt_timestamp(
-            bpy.utils.time_from_frame(item.start_frame + item.frame_duration)
-        )
-        json_data = settings_and_styles_to_json(item)
-        if len(json_data) == 0:
-            results.append(f"{start_time} --> {end_time}")
-        else:
-            results.append(f"{start_time} --> {end_time} JSON:{json.dumps(json_data)}")
-        results.append(item.text)
-        results.append("")
+def jimaku_to_srt_snapshot(item):
+    """
+    字幕情報を、字幕ブロックの作成に必要なデータに変換する
 
-    return results
+    bpyのデータを含まないため、別スレッドでsnapshot_to_srt_blockに渡せる
+    """
+    start = bpy.utils.time_from_frame(item.start_frame)
+    end = bpy.utils.time_from_frame(item.start_frame + item.frame_duration)
+    return (item.no, start, end, settings_and_styles_to_json(item), item.text)
+
+
+def snapshot_to_srt_block(snapshot):
+    """
+    jimaku_to_srt_snapshotのデータを字幕ブロックの文字列(末尾の空行を含まない)に変換する
+    """
+    no, start, end, json_data, text = snapshot
+    start_time = format_srt_timestamp(start)
+    end_time = format_srt_timestamp(end)
+    if len(json_data) == 0:
+        time_line = f"{start_time} --> {end_time}"
+    else:
+        time_line = f"{start_time} --> {end_time} JSON:{json.dumps(json_data)}"
+    return f"{no}\n{time_line}\n{text}"
+
+
+# 字幕ファイル書き込み時のバッファサイズ
+SRT_WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def write_srt_file(output_path, blocks, backup=True):
+    """
+    字幕ブロックを一時ファイルに書き出してから、字幕ファイルを置き換える
+
+    書き込み途中でクラッシュしても、元の字幕ファイルは壊れない。
+    バックアップ(.bk)はコピーせずにハードリンク(できない場合はリネーム)で作成する。
+
+    :param str output_path: 字幕ファイルのパス
+    :param blocks: 字幕ブロックの文字列を返すイテレーター
+    :param bool backup: 既存の字幕ファイルのバックアップを作成する
+    """
+    dir_path = os.path.dirname(output_path)
+    with my_files.atomic_write(
+        output_path,
+        "w",
+        encoding="utf-8",
+        newline="\n",
+        buffering=SRT_WRITE_BUFFER_SIZE,
+    ) as f:
+        for block in blocks:
+            f.write(block)
+            f.write("\n\n")
+        f.flush()
+        os.fsync(f.fileno())
+        if backup and os.path.exists(output_path):
+            backup_path = output_path + ".bk"
+            if os.path.exists(backup_path):
+                os.remove(backup_path)
+            try:
+                os.link(output_path, backup_path)
+            except OSError:
+                os.rename(output_path, backup_path)
+    fsync_directory(dir_path)
+
+
+def fsync_directory(dir_path):
+    # リネームを永続化する (ディレクトリをopenできないWindowsでは何もしない)
+    if os.name != "posix":
+        return
+    fd = os.open(dir_path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def float_vector_to_hexcolor(vector):
@@ -230,6 +289,7 @@ def create_gimp_script(
     default_config,
     additional_sys_path=get_addon_directory(),
     debug=False,
+    cache_dir=None,
 ):
     script = f"""# -*- coding: utf-8 -*-
 import json
@@ -243,8 +303,24 @@ config = {repr(config)}
 default_config = {repr(default_config)}
 output_path = {repr(output_path)}
 debug = {debug}
+cache_dir = {repr(cache_dir)}
+
+subtitle_creator.run(
+    subtitles, config, output_path, default_config, debug, cache_dir
+)
+"""
+    return script
+
+
+def create_gimp_server_script(
+    port_path, token, idle_timeout, additional_sys_path=get_addon_directory()
+):
+    script = f"""# -*- coding: utf-8 -*-
+import sys
+sys.path=[{repr(additional_sys_path)}]+sys.path
+import subtitle_creator
 
-subtitle_creator.run(subtitles, config, output_path, default_config, debug)
+subtitle_creator.serve({repr(port_path)}, {repr(token)}, {idle_timeout})
 """
     return script
 
@@ -293,6 +369,27 @@ def get_srtloader_preset_path():
     return os.path.join(user_script_path, DEFAULT_STRLOARDER_PRESET_PATH)
 
 
+def get_srt_cache_dir():
+    preset_path = get_srtloader_preset_path()
+    if preset_path is None:
+        return
+    return os.path.join(preset_path, "srt_cache")
+
+
+def get_render_cache_dir():
+    preset_path = get_srtloader_preset_path()
+    if preset_path is None:
+        return
+    return os.path.join(preset_path, "render_cache")
+
+
+def get_font_index_path():
+    preset_path = get_srtloader_preset_path()
+    if preset_path is None:
+        return
+    return os.path.join(preset_path, "font_index.json")
+
+
 def setup_styles_json():
     preset_path = get_srtloader_preset_path()
     if preset_path is None: